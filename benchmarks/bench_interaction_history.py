@@ -0,0 +1,98 @@
+"""interaction_historyへの追記コストを、セッションを作り直す従来の方式と比較するマイクロベンチマーク
+
+    python benchmarks/bench_interaction_history.py
+
+従来の「get_session → state全体をコピー → create_sessionで作り直す」方式と、
+状態差分をイベントとして追記する現在の方式で、履歴がN件ある時点での1回あたりの追記時間を比較する。
+履歴の圧縮（INTERACTION_HISTORY_TOKEN_BUDGET）の効果と混ざらないよう、両方式に同じ圧縮の設定と
+同じエントリー（timestamp付き）を使い、トークン予算あり・なしの2通りで計測する。
+get_sessionが状態全体をコピーするため、どちらの方式も1回あたりのコストは保持している履歴の量に比例する
+（長さによらず一定に保たれるのはトークン予算で履歴を圧縮しているため）。
+"""
+import asyncio
+import math
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import (  # noqa: E402
+    INTERACTION_HISTORY_TOKEN_BUDGET,
+    TurnScopedSessionService,
+    compact_interaction_history,
+    update_interaction_history,
+)
+
+APP_NAME = "bench"
+USER_ID = "bench_user"
+CHECKPOINTS = (10, 100, 500, 1000)
+SAMPLES = 20
+# (表示名, トークン予算)。予算なしは履歴をすべて残す
+BUDGETS = (
+    (f"capped ({INTERACTION_HISTORY_TOKEN_BUDGET} tokens)", INTERACTION_HISTORY_TOKEN_BUDGET),
+    ("uncapped", math.inf),
+)
+
+
+async def legacy_update_interaction_history(session_service, app_name, user_id, session_id, entry, token_budget):
+    """以前の実装（セッションを毎回作り直す）に、現在の方式と同じ圧縮を加えたもの"""
+    session = await session_service.get_session(
+        app_name=app_name, user_id=user_id, session_id=session_id
+    )
+    interaction_history, interaction_summary = compact_interaction_history(
+        session.state.get("interaction_history", []) + [entry],
+        session.state.get("interaction_summary", ""),
+        token_budget,
+    )
+    updated_state = session.state.copy()
+    updated_state["interaction_history"] = interaction_history
+    updated_state["interaction_summary"] = interaction_summary
+    await session_service.create_session(
+        app_name=app_name, user_id=user_id, session_id=session_id, state=updated_state
+    )
+
+
+def make_entry(turn: int) -> dict:
+    # 現在の方式が付けるtimestampを先に付けておき、両方式で同じデータを保存する
+    return {
+        "action": "agent_response",
+        "agent": "recommend_agent",
+        "response": f"{turn}: " + "おすすめはアイラ島のシングルモルトです。" * 5,
+        "timestamp": datetime.now(timezone(timedelta(hours=9))),
+    }
+
+
+async def measure(update, token_budget) -> dict:
+    session_service = TurnScopedSessionService()
+    session = await session_service.create_session(
+        app_name=APP_NAME, user_id=USER_ID, state={"interaction_history": []}
+    )
+    results = {}
+    turn = 0
+    for checkpoint in CHECKPOINTS:
+        while turn < checkpoint:
+            await update(session_service, APP_NAME, USER_ID, session.id, make_entry(turn), token_budget)
+            turn += 1
+        started_at = time.perf_counter()
+        for _ in range(SAMPLES):
+            await update(session_service, APP_NAME, USER_ID, session.id, make_entry(turn), token_budget)
+            turn += 1
+        results[checkpoint] = (time.perf_counter() - started_at) / SAMPLES * 1_000_000
+    return results
+
+
+async def main():
+    for label, token_budget in BUDGETS:
+        legacy = await measure(legacy_update_interaction_history, token_budget)
+        current = await measure(update_interaction_history, token_budget)
+        print(f"history compaction: {label}")
+        print(f"{'turns':>15} {'legacy (us/op)':>16} {'delta (us/op)':>15}")
+        for checkpoint in CHECKPOINTS:
+            print(f"{checkpoint:>15} {legacy[checkpoint]:>16.1f} {current[checkpoint]:>15.1f}")
+        print()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,105 @@
+import asyncio
+import time
+
+
+class ContentTooLargeError(ValueError):
+    """ダウンロードするコンテンツがサイズ上限を超えた場合の例外"""
+
+
+class DownloadStats:
+    """画像ダウンロードのスループットを集計する"""
+
+    def __init__(self):
+        self.downloads = 0
+        self.total_bytes = 0
+        self.total_seconds = 0.0
+        self.too_large = 0
+        self.timeouts = 0
+        self.last_throughput_mbps = 0.0
+
+    def record(self, size: int, seconds: float) -> float:
+        """1件分のダウンロード結果を記録し、スループット(MB/s)を返す"""
+        throughput = size / seconds / 1_000_000 if seconds > 0 else 0.0
+        self.downloads += 1
+        self.total_bytes += size
+        self.total_seconds += seconds
+        self.last_throughput_mbps = throughput
+        return throughput
+
+    def stats(self) -> dict:
+        return {
+            "downloads": self.downloads,
+            "total_bytes": self.total_bytes,
+            "avg_throughput_mbps": round(self.total_bytes / self.total_seconds / 1_000_000, 3) if self.total_seconds else 0.0,
+            "last_throughput_mbps": round(self.last_throughput_mbps, 3),
+            "too_large": self.too_large,
+            "timeouts": self.timeouts,
+        }
+
+
+download_stats = DownloadStats()
+
+
+async def _read_into_buffer(message_content, max_bytes: int, chunk_size: int) -> memoryview:
+    # Content-Lengthが分かる場合はその長さで一度だけ確保し、分からない場合は倍々で拡張する
+    content_length = message_content.response.headers.get("content-length")
+    if content_length is not None:
+        if int(content_length) > max_bytes:
+            raise ContentTooLargeError(f"Content-Length {content_length} exceeds limit {max_bytes}")
+        buffer = bytearray(int(content_length))
+    else:
+        buffer = bytearray(min(max_bytes, 256 * 1024))
+
+    size = 0
+    async for chunk in message_content.iter_content(chunk_size):
+        end = size + len(chunk)
+        if end > max_bytes:
+            raise ContentTooLargeError(f"Content exceeds limit {max_bytes} bytes")
+        if end > len(buffer):
+            new_size = min(max(len(buffer) * 2, end), max_bytes)
+            buffer.extend(bytes(new_size - len(buffer)))
+        buffer[size:end] = chunk
+        size = end
+
+    # コピーせずに有効部分だけを参照する
+    return memoryview(buffer)[:size]
+
+
+async def download_message_content(
+    line_bot_api,
+    message_id: str,
+    max_bytes: int = 10 * 1024 * 1024,
+    timeout: float = 30.0,
+    chunk_size: int = 64 * 1024,
+) -> memoryview:
+    """LINEのメッセージコンテンツをストリーミングで取得する
+
+    Args:
+        line_bot_api: AsyncLineBotApiインスタンス
+        message_id: メッセージID
+        max_bytes: 許容する最大サイズ（バイト）
+        timeout: ダウンロード全体のタイムアウト（秒）
+        chunk_size: 1回に読み込むチャンクサイズ
+    Returns:
+        取得したデータを指すmemoryview（コピーなし）
+    Raises:
+        ContentTooLargeError: サイズ上限を超えた場合
+        asyncio.TimeoutError: タイムアウトした場合
+    """
+    started_at = time.monotonic()
+    try:
+        message_content = await line_bot_api.get_message_content(message_id, timeout=timeout)
+        data = await asyncio.wait_for(
+            _read_into_buffer(message_content, max_bytes, chunk_size), timeout=timeout
+        )
+    except ContentTooLargeError:
+        download_stats.too_large += 1
+        raise
+    except asyncio.TimeoutError:
+        download_stats.timeouts += 1
+        raise
+
+    elapsed = time.monotonic() - started_at
+    throughput = download_stats.record(len(data), elapsed)
+    print(f"Downloaded content {message_id}: {len(data)} bytes in {elapsed * 1000:.0f} ms ({throughput:.2f} MB/s)")
+    return data
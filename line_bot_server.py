@@ -1,8 +1,7 @@
 import os
 import asyncio
-import tempfile
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Union
 from fastapi import FastAPI, Request, HTTPException
 from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
 from linebot import AsyncLineBotApi, WebhookParser
@@ -11,10 +10,16 @@ from linebot.models import MessageEvent, TextMessage, ImageMessage, TextSendMess
 from dotenv import load_dotenv
 import aiohttp
 from google.adk.runners import Runner
-from google.adk.sessions import InMemorySessionService
 from google.adk.artifacts import InMemoryArtifactService
 from whisky_agent.agent import root_agent
-from utils import call_agent_async, initialize_whisky_agent_system
+from whisky_agent.sub_agents.image_agent.sub_agents.whisky_label_processor import adaptive_resolution_stats
+from whisky_agent.label_cache import label_cache
+from whisky_agent.router import router_stats
+from whisky_agent.storage import aggregate_stats, cooccurrence_index, firestore_client_pool, firestore_executor, get_firestore_client_async, history_cache, note_index, trend_cache, user_sampling_stats, write_behind_queue
+from utils import TurnScopedSessionService, call_agent_async, initialize_whisky_agent_system, state_logger
+from work_queue import WorkQueue
+from user_mailbox import UserMailboxes
+from image_download import ContentTooLargeError, download_message_content, download_stats
 
 load_dotenv()
 
@@ -29,14 +34,27 @@ line_bot_api = AsyncLineBotApi(os.getenv('LINE_CHANNEL_ACCESS_TOKEN'), async_htt
 parser = WebhookParser(os.getenv('LINE_CHANNEL_SECRET'))
 
 # ADK設定
-session_service = InMemorySessionService()
+session_service = TurnScopedSessionService()
 artifact_service = InMemoryArtifactService()
 runner = None
 APP_NAME = "Whisky Assistant"
 
+# 画像ダウンロードの上限設定
+IMAGE_MAX_BYTES = int(os.getenv("LINE_IMAGE_MAX_BYTES", 10 * 1024 * 1024))
+IMAGE_DOWNLOAD_TIMEOUT = float(os.getenv("LINE_IMAGE_DOWNLOAD_TIMEOUT", 30))
+
+# 本番ではセッション状態の全量表示をやめ、サンプリングした構造化ログにする
+state_logger.set_mode(os.getenv("STATE_LOG_MODE", "structured"))
+
 # シンプルなメモリ内セッション管理
 active_sessions = {}
 
+# Webhookイベントのバックグラウンド処理キュー
+work_queue = WorkQueue(
+    maxsize=int(os.getenv("WEBHOOK_QUEUE_MAXSIZE", 100)),
+    num_workers=int(os.getenv("WEBHOOK_WORKERS", 4)),
+)
+
 
 def format_line_response(text: str) -> str:
     """
@@ -93,7 +111,7 @@ async def get_or_create_session_for_user(user_id: str):
         return fallback_session.id
 
 
-async def process_with_multi_agent(user_id: str, query: str, image_data: Optional[bytes] = None) -> str:
+async def process_with_multi_agent(user_id: str, query: str, image_data: Optional[Union[bytes, memoryview]] = None) -> str:
     """ADKマルチエージェントシステムでメッセージを処理（最適化版）"""
     try:
         print(f"Processing with ADK multi-agent system - User: {user_id}, Query: {query[:50]}...")
@@ -101,28 +119,13 @@ async def process_with_multi_agent(user_id: str, query: str, image_data: Optiona
         # ADKセッションを取得または作成
         session_id = await get_or_create_session_for_user(user_id)
 
-        # 画像処理（メモリ内で処理、ファイルI/Oを避ける）
-        image_path = None
-        if image_data:
-            # 一時ファイル作成を最小限に
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_file:
-                temp_file.write(image_data)
-                image_path = temp_file.name
-
         # 履歴追加をスキップ（メモリのみセッション管理）
 
-        # ADKマルチエージェントを呼び出し
+        # ADKマルチエージェントを呼び出し（画像は一時ファイルを経由せずメモリのまま渡す）
         response = await call_agent_async(
-            runner, user_id, session_id, query=query, image_path=image_path
+            runner, user_id, session_id, query=query, image_data=image_data
         )
 
-        # 一時ファイル削除
-        if image_path and os.path.exists(image_path):
-            try:
-                os.unlink(image_path)
-            except Exception as e:
-                print(f"Failed to delete temporary file: {e}")
-
         if not response or response.strip() == "":
             response = "申し訳ございませんが、応答を取得できませんでした。もう一度お試しください。"
 
@@ -142,12 +145,35 @@ async def health_check():
         "service": "adk_multi_agent_line_bot",
         "adk_runner": adk_status,
         "active_sessions": len(active_sessions),
+        "queue_depth": work_queue.stats()["queue_depth"],
         "ready": True
     }
 
+@app.get("/metrics")
+async def metrics():
+    """インスタンスのサイジング用メトリクス"""
+    return {
+        "webhook_queue": work_queue.stats(),
+        "user_mailboxes": user_mailboxes.stats(),
+        "image_downloads": download_stats.stats(),
+        "label_adaptive_resolution": adaptive_resolution_stats.stats(),
+        "label_cache": label_cache.stats(),
+        "fast_path_router": router_stats.stats(),
+        "state_logging": state_logger.stats(),
+        "firestore_client": firestore_client_pool.stats(),
+        "firestore_executor": firestore_executor.stats(),
+        "firestore_write_behind": write_behind_queue.stats(),
+        "history_cache": history_cache.stats(),
+        "trend_cache": trend_cache.stats(),
+        "cooccurrence_index": cooccurrence_index.stats(),
+        "note_index": note_index.stats(),
+        "user_sampling": user_sampling_stats.stats(),
+        "user_aggregates": aggregate_stats.stats(),
+    }
+
 @app.post("/webhook")
 async def handle_webhook(request: Request):
-    """LINE Webhook処理（完全非同期版）"""
+    """LINE Webhook処理（署名検証後にキューへ積み、即座に応答する）"""
     signature = request.headers.get('X-Line-Signature', '')
     body = await request.body()
     body_text = body.decode('utf-8')
@@ -157,26 +183,44 @@ async def handle_webhook(request: Request):
     except InvalidSignatureError:
         raise HTTPException(status_code=400, detail="Invalid signature")
 
-    # 全てのイベントを並行処理
-    tasks = []
+    # イベントをユーザーごとのメールボックス経由でワーカープールに委ねる
     for event in events:
-        if isinstance(event, MessageEvent):
-            if isinstance(event.message, TextMessage):
-                tasks.append(handle_text_message_async(event))
-            elif isinstance(event.message, ImageMessage):
-                tasks.append(handle_image_message_async(event))
-
-    # 全てのタスクを並行実行
-    if tasks:
-        await asyncio.gather(*tasks, return_exceptions=True)
+        if isinstance(event, MessageEvent) and isinstance(event.message, (TextMessage, ImageMessage)):
+            if not user_mailboxes.post(event.source.user_id, event):
+                # 受け付けられなかったイベントはLINEから再送されないため、混雑している旨をその場で返信する
+                await reply_busy(event)
 
     return "OK"
 
-async def handle_text_message_async(event):
+async def reply_busy_all(user_id: str, events: list):
+    """受け付けた後にキューが満杯になり処理できなかったイベントに、混雑している旨を返信する"""
+    for event in events:
+        await reply_busy(event)
+
+async def reply_busy(event):
+    """キューが満杯で処理できないイベントに、時間をおいて送り直すよう返信する"""
+    try:
+        await line_bot_api.reply_message(
+            event.reply_token,
+            TextSendMessage(text="申し訳ありません。現在混み合っています。しばらくしてからもう一度お試しください。")
+        )
+    except Exception as reply_error:
+        print(f"Failed to send busy reply: {reply_error}")
+
+async def handle_user_events(user_id: str, events: list):
+    """メールボックスから取り出した1ターン分のイベントを処理"""
+    if isinstance(events[0].message, ImageMessage):
+        await handle_image_message_async(events[0])
+    else:
+        # 連続したテキストは1つの問い合わせにまとめ、最新のreply tokenで返信する
+        query = "\n".join(event.message.text for event in events)
+        await handle_text_message_async(events[-1], query)
+
+async def handle_text_message_async(event, user_query: Optional[str] = None):
     """テキストメッセージの非同期処理"""
     try:
         user_id = event.source.user_id
-        user_query = event.message.text
+        user_query = user_query or event.message.text
 
         print(f"Processing text message - User: {user_id}, Query: {user_query[:50]}...")
 
@@ -207,13 +251,13 @@ async def handle_image_message_async(event):
         user_id = event.source.user_id
         print(f"Processing image message - User: {user_id}")
 
-        # 非同期で画像データを取得
-        message_content = await line_bot_api.get_message_content(event.message.id)
-        image_data = b''
-        async for chunk in message_content.iter_content():
-            image_data += chunk
-
-        print(f"Image data retrieved, size: {len(image_data)} bytes")
+        # 画像データをストリーミングで取得（サイズ上限・タイムアウト付き）
+        image_data = await download_message_content(
+            line_bot_api,
+            event.message.id,
+            max_bytes=IMAGE_MAX_BYTES,
+            timeout=IMAGE_DOWNLOAD_TIMEOUT,
+        )
 
         # ADKマルチエージェントシステムで画像分析
         response = await process_with_multi_agent(
@@ -230,6 +274,16 @@ async def handle_image_message_async(event):
         )
         print(f"Image analysis response sent successfully for user {user_id}")
 
+    except ContentTooLargeError as e:
+        print(f"Image too large: {e}")
+        try:
+            await line_bot_api.reply_message(
+                event.reply_token,
+                TextSendMessage(text="申し訳ありません。画像サイズが大きすぎます。小さい画像でもう一度お試しください。")
+            )
+        except Exception as reply_error:
+            print(f"Failed to send image error reply: {reply_error}")
+
     except Exception as e:
         print(f"Error processing image message: {e}")
         try:
@@ -240,10 +294,33 @@ async def handle_image_message_async(event):
         except Exception as reply_error:
             print(f"Failed to send image error reply: {reply_error}")
 
+# ユーザーごとの順序付きメールボックス（同一ユーザーは直列、ユーザー間は並列）
+user_mailboxes = UserMailboxes(
+    work_queue,
+    handle_user_events,
+    can_coalesce=lambda event: isinstance(event.message, TextMessage),
+    coalesce_window=int(os.getenv("MAILBOX_COALESCE_WINDOW_MS", 500)) / 1000,
+    max_pending=int(os.getenv("MAILBOX_MAX_PENDING", 20)),
+    on_dropped=reply_busy_all,
+)
+
+# アプリケーション起動時の処理
+@app.on_event("startup")
+async def startup_event():
+    """ワーカープールを起動し、Firestoreクライアントを作成して共起・テイスティングノートのインデックスの作成をバックグラウンドで始める"""
+    await work_queue.start()
+    # 最初のリクエストの処理中に作成しないよう、起動時に作成しておく
+    firestore_client = await get_firestore_client_async()
+    firestore_client.schedule_index_rebuild()
+
 # アプリケーション終了時のクリーンアップ
 @app.on_event("shutdown")
 async def shutdown_event():
     """アプリケーション終了時の処理"""
+    await work_queue.stop()
+    # 書き込みキューに残った保存をFirestoreへ書き出す
+    await asyncio.to_thread(write_behind_queue.stop)
+    state_logger.stop()
     if session:
         await session.close()
     print("Application shutdown completed")
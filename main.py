@@ -1,15 +1,14 @@
 from dotenv import load_dotenv
 from google.adk.runners import Runner
-from google.adk.sessions import InMemorySessionService
 from google.adk.artifacts import InMemoryArtifactService
-from utils import add_user_query_to_history, call_agent_async, create_or_get_session, initialize_whisky_agent_system
+from utils import TurnScopedSessionService, add_user_query_to_history, call_agent_async, create_or_get_session, initialize_whisky_agent_system
 import asyncio
 
 # 環境変数の読み込み
 load_dotenv()
 
 # セッションサービスの作成
-session_service = InMemorySessionService()
+session_service = TurnScopedSessionService()
 artifact_service = InMemoryArtifactService()
 
 async def main_async():
@@ -0,0 +1,140 @@
+import json
+import logging
+import queue
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+# セッション状態の出力モード
+#   display    : 従来どおりターミナルに整形して表示する（main.pyでのデバッグ用）
+#   structured : サンプリングし、サイズを制限したJSONをバックグラウンドで出力する（本番用）
+#   off        : 出力しない
+STATE_LOG_MODES = ("display", "structured", "off")
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """キューが満杯のときはブロックせずにレコードを破棄するQueueHandler"""
+
+    def __init__(self, log_queue, on_drop):
+        super().__init__(log_queue)
+        self._on_drop = on_drop
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._on_drop()
+
+
+class StateLogger:
+    """セッション状態の構造化ログを出力する
+
+    ログの書き込みはQueueHandler経由でバックグラウンドスレッド(QueueListener)に任せるため、
+    リクエスト処理側は1行分のJSONを組み立ててキューに積むだけで済む。
+    """
+
+    def __init__(self, mode: str = "display", sample_rate: float = 0.1, max_chars: int = 2000, queue_size: int = 1000):
+        """
+        Args:
+            mode: 出力モード（STATE_LOG_MODESのいずれか）
+            sample_rate: structuredモードで出力するターンの割合（0〜1）
+            max_chars: 1レコードに含める状態JSONの最大文字数
+            queue_size: 書き込み待ちレコードの上限（超えた分は破棄する）
+        """
+        self.sample_rate = sample_rate
+        self.max_chars = max_chars
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._logger = logging.getLogger("whisky.session_state")
+        self._logger.setLevel(logging.INFO)
+        self._logger.propagate = False
+        self._handler = _DroppingQueueHandler(self._queue, self._count_drop)
+        self._listener = None
+        self.mode = "display"
+        self.set_mode(mode)
+
+        # メトリクス
+        self.logged = 0
+        self.skipped = 0
+        self.truncated = 0
+        self.dropped = 0
+
+    def _count_drop(self):
+        self.dropped += 1
+
+    def set_mode(self, mode: str):
+        """出力モードを切り替える（structuredの場合はバックグラウンド出力を開始する）"""
+        if mode not in STATE_LOG_MODES:
+            print(f"Unknown state log mode '{mode}', using 'structured'")
+            mode = "structured"
+        self.mode = mode
+        if mode == "structured":
+            self.start()
+        else:
+            self.stop()
+
+    def start(self):
+        if self._listener is not None:
+            return
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(logging.Formatter("%(message)s"))
+        self._listener = QueueListener(self._queue, stream_handler)
+        self._listener.start()
+        self._logger.addHandler(self._handler)
+
+    def stop(self):
+        """キューに残ったレコードを書き出してからバックグラウンド出力を止める"""
+        if self._listener is None:
+            return
+        self._logger.removeHandler(self._handler)
+        self._listener.stop()
+        self._listener = None
+
+    def should_log(self) -> bool:
+        """このターンの状態を出力するかをサンプリングで決める"""
+        if self.mode != "structured":
+            return False
+        if random.random() < self.sample_rate:
+            return True
+        self.skipped += 1
+        return False
+
+    def log_state(self, label: str, user_id: str, session_id: str, state: dict):
+        """状態を1行のJSONとして出力する（対話履歴は件数のみ、全体はmax_charsで切り詰める）"""
+        history = state.get("interaction_history", [])
+        state_json = json.dumps(
+            {key: value for key, value in state.items() if key != "interaction_history"},
+            ensure_ascii=False,
+            default=str,
+        )
+        truncated = len(state_json) > self.max_chars
+        if truncated:
+            state_json = state_json[: self.max_chars]
+            self.truncated += 1
+
+        self._logger.info(
+            json.dumps(
+                {
+                    "severity": "INFO",
+                    "message": label,
+                    "user_id": user_id,
+                    "session_id": session_id,
+                    "interaction_history_len": len(history),
+                    "state_keys": sorted(state.keys()),
+                    "state": state_json,
+                    "state_truncated": truncated,
+                },
+                ensure_ascii=False,
+            )
+        )
+        self.logged += 1
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "sample_rate": self.sample_rate,
+            "logged": self.logged,
+            "skipped": self.skipped,
+            "truncated": self.truncated,
+            "dropped": self.dropped,
+            "queue_depth": self._queue.qsize(),
+        }
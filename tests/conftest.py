@@ -0,0 +1,6 @@
+import os
+import sys
+
+# whisky_agentのimport時にニュース検索ツールがAPIキーを要求するため、未設定の場合はダミーを入れる
+os.environ.setdefault("TAVILY_API_KEY", "test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
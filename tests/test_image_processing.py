@@ -0,0 +1,44 @@
+import io
+import os
+
+from PIL import Image
+
+from whisky_agent.image_processing import preprocess_image
+
+GPS_IFD = 0x8825
+
+
+def _noisy_jpeg(exif=None) -> bytes:
+    """再エンコードしても小さくならない、低品質でノイズの多いJPEGを作る"""
+    image = Image.frombytes("RGB", (200, 200), os.urandom(200 * 200 * 3))
+    output = io.BytesIO()
+    if exif is None:
+        image.save(output, format="JPEG", quality=20)
+    else:
+        image.save(output, format="JPEG", quality=20, exif=exif)
+    return output.getvalue()
+
+
+def test_keeps_original_without_metadata_when_not_smaller():
+    original = _noisy_jpeg()
+    processed, mime_type = preprocess_image(original)
+    assert processed is original
+    assert mime_type == "image/jpeg"
+
+
+def test_strips_exif_even_when_reencoding_is_not_smaller():
+    exif = Image.Exif()
+    exif[0x010F] = "PhoneMaker"  # Make
+    exif[0x0110] = "PhoneModel"  # Model
+    exif.get_ifd(GPS_IFD).update({1: "N", 2: (35.0, 41.0, 22.0), 3: "E", 4: (139.0, 41.0, 30.0)})
+    original = _noisy_jpeg(exif)
+    assert Image.open(io.BytesIO(original)).getexif()
+
+    processed, mime_type = preprocess_image(original)
+    assert processed is not original
+    assert mime_type == "image/jpeg"
+    with Image.open(io.BytesIO(processed)) as image:
+        assert not image.getexif()
+        assert "exif" not in image.info
+        assert not image.getexif().get_ifd(GPS_IFD)
+        assert all(marker == "APP0" for marker, _ in image.applist)
@@ -0,0 +1,23 @@
+import pytest
+
+from whisky_agent.storage.index_base import RebuildableIndex
+
+
+def test_incomplete_subclass_fails_on_creation():
+    class MissingSwap(RebuildableIndex):
+        def _new_empty(self):
+            return MissingSwap()
+
+        def _apply(self, user_id, whisky_id, data):
+            return True
+
+    with pytest.raises(TypeError):
+        MissingSwap()
+
+
+def test_existing_indexes_implement_all_abstract_methods():
+    from whisky_agent.storage.cooccurrence import CooccurrenceIndex
+    from whisky_agent.storage.note_index import NoteVectorIndex
+
+    assert not CooccurrenceIndex.__abstractmethods__
+    assert not NoteVectorIndex.__abstractmethods__
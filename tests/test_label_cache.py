@@ -0,0 +1,50 @@
+import io
+import random
+import shelve
+
+from PIL import Image, ImageDraw, ImageFont
+
+from whisky_agent.label_cache import LabelCache, label_hashes
+
+
+def _label(age: str, quality: int = 90) -> bytes:
+    """同じレイアウトで熟成年数の表記だけが違うラベル画像を作る"""
+    image = Image.new("RGB", (400, 600), (240, 230, 200))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((50, 100, 350, 500), outline="black", width=8)
+    draw.text((110, 230), age, fill="black", font=ImageFont.load_default(size=90))
+    draw.text((90, 380), "YAMAZAKI", fill="black", font=ImageFont.load_default(size=40))
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=quality)
+    return output.getvalue()
+
+
+def test_same_layout_with_different_age_is_not_a_hit():
+    cache = LabelCache()
+    cache.put(*label_hashes(_label("12")), {"brand": "山崎", "age": "12年"})
+
+    assert cache.get(*label_hashes(_label("12", quality=70))) == {"brand": "山崎", "age": "12年"}
+    assert cache.get(*label_hashes(_label("18"))) is None
+    assert cache.rejected_matches == 1
+
+
+def test_reload_keeps_most_recent_entries_regardless_of_key_order(tmp_path):
+    path = str(tmp_path / "labels")
+    cache = LabelCache(max_entries=3, store_path=path)
+    for index in range(6):
+        cache.put(index, index, {"brand": str(index)})
+    cache._store_executor.shutdown(wait=True)
+    entries = {key: cache._store[key] for key in cache._store.keys()}
+    cache._store.close()
+
+    # キーの列挙順に依存しないことを確かめるため、順序を入れ替えて書き直す
+    keys = list(entries)
+    random.Random(0).shuffle(keys)
+    with shelve.open(path, flag="n") as store:
+        for key in keys:
+            store[key] = entries[key]
+
+    reloaded = LabelCache(max_entries=2, store_path=path)
+    assert [entry["info"]["brand"] for entry in reloaded._entries.values()] == ["4", "5"]
+    reloaded.put(9, 9, {"brand": "9"})
+    assert reloaded._entries[9]["seq"] > reloaded._entries[5]["seq"]
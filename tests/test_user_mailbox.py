@@ -0,0 +1,61 @@
+import asyncio
+
+from user_mailbox import UserMailboxes
+from work_queue import WorkQueue
+
+
+def test_coalescing_wait_does_not_hold_a_worker():
+    async def scenario():
+        work_queue = WorkQueue(maxsize=10, num_workers=1)
+        await work_queue.start()
+        turns = []
+
+        async def handler(user_id, items):
+            turns.append((user_id, items))
+
+        mailboxes = UserMailboxes(work_queue, handler, can_coalesce=lambda item: True, coalesce_window=0.2)
+        assert mailboxes.post("u1", "a")
+        assert mailboxes.post("u1", "b")
+        assert mailboxes.post("u2", "c")
+        # 待ち時間の間はワーカーを占有しない
+        await asyncio.sleep(0.1)
+        assert work_queue.stats()["busy_workers"] == 0
+        assert turns == []
+
+        await asyncio.sleep(0.2)
+        await work_queue.stop()
+        return turns
+
+    turns = asyncio.run(scenario())
+    assert sorted(turns) == [("u1", ["a", "b"]), ("u2", ["c"])]
+
+
+def test_messages_are_handed_to_on_dropped_when_queue_fills_during_wait():
+    async def scenario():
+        work_queue = WorkQueue(maxsize=1, num_workers=1)
+        await work_queue.start()
+        dropped = []
+        release = asyncio.Event()
+
+        async def handler(user_id, items):
+            await release.wait()
+
+        async def on_dropped(user_id, items):
+            dropped.append((user_id, items))
+
+        mailboxes = UserMailboxes(work_queue, handler, coalesce_window=0.05, on_dropped=on_dropped)
+        assert mailboxes.post("u1", "a")
+        await asyncio.sleep(0.1)
+        # u1の処理中に届いたu2がキューの空きを使い、u3は待ち時間の後に積めずに破棄される
+        assert mailboxes.post("u2", "b")
+        assert mailboxes.post("u3", "c")
+        await asyncio.sleep(0.1)
+        # キューが満杯の場合はその場で受け付けない
+        assert not mailboxes.post("u4", "d")
+        release.set()
+        await work_queue.stop()
+        return dropped, mailboxes.stats()
+
+    dropped, stats = asyncio.run(scenario())
+    assert dropped == [("u3", ["c"])]
+    assert stats["dropped"] == 2
@@ -0,0 +1,126 @@
+import asyncio
+import time
+
+import pytest
+
+from whisky_agent.storage import firestore as firestore_module
+from whisky_agent.storage.firestore import FirestoreClient
+from whisky_agent.storage.history_cache import history_cache
+from whisky_agent.storage.write_behind import WriteBehindQueue, write_behind_enabled
+
+
+class FakeRef:
+    def __init__(self, path: str):
+        self.path = path
+
+    def collection(self, name: str) -> "FakeRef":
+        return FakeRef(f"{self.path}/{name}")
+
+    def document(self, document_id: str) -> "FakeRef":
+        return FakeRef(f"{self.path}/{document_id}")
+
+
+class FakeBatch:
+    def __init__(self, db: "FakeDB"):
+        self._db = db
+        self._writes = []
+
+    def set(self, doc_ref, data, merge=False):
+        self._writes.append((doc_ref.path, dict(data)))
+
+    def commit(self):
+        self._db.batch_commits.append(self._writes)
+
+
+class FakeDB:
+    def __init__(self):
+        self.batch_commits = []
+
+    def collection(self, name: str) -> FakeRef:
+        return FakeRef(name)
+
+    def batch(self) -> FakeBatch:
+        return FakeBatch(self)
+
+
+def _client(monkeypatch, events: list) -> FirestoreClient:
+    client = FirestoreClient.__new__(FirestoreClient)
+    client.db = FakeDB()
+    client._indexed_user_ids = {"u1", "u2"}
+    monkeypatch.setattr(client, "_write_whisky_doc", lambda user_id, doc_ref, data: events.append(("direct", doc_ref.path)))
+    monkeypatch.setattr(client, "_ensure_user_random_key", lambda user_id: None)
+    monkeypatch.setattr(client, "_patch_caches", lambda user_id, whisky_id, data: events.append(("patch", whisky_id)))
+    return client
+
+
+@pytest.mark.parametrize("write_behind", [True, False])
+@pytest.mark.parametrize("aggregates_enabled", [True, False])
+def test_save_uses_batches_only_when_write_behind_is_on_and_aggregates_are_off(monkeypatch, write_behind, aggregates_enabled):
+    enabled = write_behind_enabled(write_behind, aggregates_enabled)
+    assert enabled == (write_behind and not aggregates_enabled)
+
+    queue = WriteBehindQueue(flush_interval=0.05)
+    monkeypatch.setattr(firestore_module, "WRITE_BEHIND_ENABLED", enabled)
+    monkeypatch.setattr(firestore_module, "write_behind_queue", queue)
+    events = []
+    client = _client(monkeypatch, events)
+
+    async def save_both():
+        await client.save_whisky_info_async("u1", "w1", {"brand": "山崎"})
+        await client.save_whisky_info_async("u2", "w2", {"brand": "白州"})
+
+    asyncio.run(save_both())
+
+    if enabled:
+        # 応答時点ではまだコミットもキャッシュへの反映もされていない
+        assert events == []
+        queue.stop()
+        assert len(client.db.batch_commits) == 1
+        assert {path for path, _ in client.db.batch_commits[0]} == {
+            "users/u1/whisky_collection/w1",
+            "users/u2/whisky_collection/w2",
+        }
+        assert events == [("patch", "w1"), ("patch", "w2")]
+    else:
+        # コミットが終わってから応答し、キューは使わない
+        assert events == [
+            ("direct", "users/u1/whisky_collection/w1"),
+            ("patch", "w1"),
+            ("direct", "users/u2/whisky_collection/w2"),
+            ("patch", "w2"),
+        ]
+        assert queue.enqueued == 0
+        assert client.db.batch_commits == []
+
+
+def test_dropped_write_does_not_run_commit_callback():
+    class FailingDB(FakeDB):
+        def batch(self):
+            raise RuntimeError("unavailable")
+
+    queue = WriteBehindQueue(flush_interval=0.01, max_attempts=2)
+    called = []
+    queue.enqueue(
+        FailingDB(),
+        FakeRef("users/u1/whisky_collection/w1"),
+        {"brand": "山崎"},
+        on_commit=lambda: called.append("commit"),
+        on_failure=lambda: called.append("failure"),
+    )
+    time.sleep(0.2)
+    queue.stop()
+    assert called == ["failure"]
+    assert queue.failed == 1
+
+
+def test_failed_direct_save_invalidates_cached_history(monkeypatch):
+    client = FirestoreClient.__new__(FirestoreClient)
+    client.db = FakeDB()
+    history_cache.put("u1", [{"id": "w1", "brand": "山崎"}])
+
+    def fail(user_id, doc_ref, data):
+        raise RuntimeError("unavailable")
+
+    monkeypatch.setattr(client, "_write_whisky_doc", fail)
+    client.save_whisky_info("u1", "w2", {"brand": "白州"})
+    assert history_cache.get("u1") is None
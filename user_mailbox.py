@@ -0,0 +1,137 @@
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from work_queue import WorkQueue
+
+
+class UserMailboxes:
+    """ユーザーごとの順序付きメールボックス
+
+    同じユーザーのメッセージは到着順に1件ずつ処理し（同一ADKセッションの競合を防ぐ）、
+    異なるユーザーのメッセージはワーカープール上で並行に処理する。
+    短時間に連続して届いた結合可能なメッセージは、1回のエージェント呼び出しにまとめる。
+    まとめるための待ち時間はタイマーで待ち、ワーカーはターンを処理している間だけ占有する。
+    """
+
+    def __init__(
+        self,
+        work_queue: WorkQueue,
+        handler: Callable[[str, List[Any]], Awaitable[None]],
+        can_coalesce: Callable[[Any], bool] = lambda item: False,
+        coalesce_window: float = 0.5,
+        max_pending: int = 20,
+        on_dropped: Optional[Callable[[str, List[Any]], Awaitable[None]]] = None,
+    ):
+        """
+        Args:
+            work_queue: メールボックスの処理を実行するワーカープール
+            handler: (user_id, items) を受け取り、まとめて処理するコルーチン関数
+            can_coalesce: 連続するメッセージを1ターンにまとめてよいかを判定する関数
+            coalesce_window: 最初のメッセージ到着から処理開始までに待つ秒数
+            max_pending: ユーザーごとに保持する未処理メッセージの上限
+            on_dropped: 受け付けた後、待ち時間の間にキューが満杯になり処理できなかったメッセージを
+                (user_id, items) で受け取るコルーチン関数
+        """
+        self._work_queue = work_queue
+        self._handler = handler
+        self._can_coalesce = can_coalesce
+        self.coalesce_window = coalesce_window
+        self.max_pending = max_pending
+        self._mailboxes: Dict[str, deque] = {}
+        self._scheduled: set = set()
+        self._on_dropped = on_dropped
+        self._dropped_tasks: set = set()
+
+        # メトリクス
+        self.posted = 0
+        self.dropped = 0
+        self.turns = 0
+        self.coalesced = 0
+        self.max_depth = 0
+
+    def post(self, user_id: str, item: Any) -> bool:
+        """ユーザーのメールボックスにメッセージを追加する
+
+        Returns:
+            受け付けた場合はTrue、上限超過やキュー満杯で破棄した場合はFalse
+        """
+        mailbox = self._mailboxes.get(user_id)
+        if mailbox is not None and len(mailbox) >= self.max_pending:
+            print(f"Mailbox for user {user_id} is full ({self.max_pending}), dropped message")
+            self.dropped += 1
+            return False
+        if user_id not in self._scheduled and not self._work_queue.can_accept():
+            self.dropped += 1
+            return False
+
+        mailbox = self._mailboxes.setdefault(user_id, deque())
+        mailbox.append(item)
+        if user_id not in self._scheduled:
+            self._scheduled.add(user_id)
+            if self.coalesce_window > 0:
+                # 連続投稿をまとめるため、ワーカーを占有せずにタイマーで待ってからキューに積む
+                asyncio.get_running_loop().call_later(self.coalesce_window, self._submit_drain, user_id)
+            else:
+                self._submit_drain(user_id)
+
+        self.posted += 1
+        self.max_depth = max(self.max_depth, len(mailbox))
+        return True
+
+    def _submit_drain(self, user_id: str):
+        """メールボックスの処理をキューに積む（満杯の場合は溜まったメッセージを破棄してon_droppedに渡す）"""
+        if self._work_queue.submit(lambda: self._drain(user_id), label=f"user:{user_id}"):
+            return
+        items = list(self._mailboxes.pop(user_id, ()))
+        self._scheduled.discard(user_id)
+        self.dropped += len(items)
+        if self._on_dropped is not None and items:
+            task = asyncio.ensure_future(self._on_dropped(user_id, items))
+            self._dropped_tasks.add(task)
+            task.add_done_callback(self._dropped_tasks.discard)
+
+    def _take_batch(self, mailbox: deque) -> List[Any]:
+        """先頭から1ターン分のメッセージを取り出す（結合可能なものは連続分をまとめる）"""
+        batch = [mailbox.popleft()]
+        if self._can_coalesce(batch[0]):
+            while mailbox and self._can_coalesce(mailbox[0]):
+                batch.append(mailbox.popleft())
+        return batch
+
+    async def _run_turn(self, user_id: str, mailbox: deque):
+        batch = self._take_batch(mailbox)
+        self.turns += 1
+        self.coalesced += len(batch) - 1
+        await self._handler(user_id, batch)
+
+    async def _drain(self, user_id: str):
+        """1ターン分を処理し、残りがあれば改めてキューに積む"""
+        mailbox = self._mailboxes[user_id]
+        try:
+            await self._run_turn(user_id, mailbox)
+        finally:
+            # 他ユーザーに公平にワーカーを回すため、残りは再度キューに積む
+            # （処理中に届いた分は既にまとめて取り出せるため待たない。キューが満杯の場合はこのワーカーで続けて処理する）
+            while mailbox and not self._work_queue.submit(
+                lambda: self._drain(user_id), label=f"user:{user_id}"
+            ):
+                try:
+                    await self._run_turn(user_id, mailbox)
+                except Exception as e:
+                    print(f"Failed to process mailbox for user {user_id}: {e}")
+            if not mailbox:
+                self._mailboxes.pop(user_id, None)
+                self._scheduled.discard(user_id)
+
+    def stats(self) -> dict:
+        """メールボックスの利用状況を返す"""
+        return {
+            "active_users": len(self._mailboxes),
+            "pending_messages": sum(len(m) for m in self._mailboxes.values()),
+            "max_depth": self.max_depth,
+            "posted": self.posted,
+            "dropped": self.dropped,
+            "turns": self.turns,
+            "coalesced_messages": self.coalesced,
+        }
@@ -1,6 +1,26 @@
 from datetime import datetime, timezone, timedelta
-import base64
+import os
+from google.adk.events import Event, EventActions
+from google.adk.sessions import InMemorySessionService
 from google.genai import types
+from whisky_agent.image_processing import preprocess_image_async
+from state_logging import StateLogger
+
+# モデル呼び出し前に画像の縮小・再エンコードを行うか
+IMAGE_PREPROCESS = os.getenv("IMAGE_PREPROCESS", "true").lower() == "true"
+
+# プロンプトに埋め込む対話履歴のトークン予算と、古いやり取りの要約の上限文字数
+INTERACTION_HISTORY_TOKEN_BUDGET = int(os.getenv("INTERACTION_HISTORY_TOKEN_BUDGET", 2000))
+INTERACTION_SUMMARY_MAX_CHARS = int(os.getenv("INTERACTION_SUMMARY_MAX_CHARS", 1000))
+INTERACTION_SUMMARY_LINE_CHARS = 60
+
+# セッション状態の出力（display: 整形表示、structured: サンプリングしたJSONを非同期出力、off: なし）
+# LINE Botサーバーは未設定時にstructuredへ切り替える
+state_logger = StateLogger(
+    mode=os.getenv("STATE_LOG_MODE", "display"),
+    sample_rate=float(os.getenv("STATE_LOG_SAMPLE_RATE", 0.1)),
+    max_chars=int(os.getenv("STATE_LOG_MAX_CHARS", 2000)),
+)
 
 
 # ANSI color codes for terminal output
@@ -30,9 +50,118 @@ class Colors:
     BG_WHITE = "\033[47m"
 
 
-async def update_interaction_history(session_service, app_name, user_id, session_id, entry):
+def estimate_tokens(entry) -> int:
+    """Roughly estimate the prompt tokens an interaction entry will take.
+
+    Japanese text is close to one token per character, so the character count of
+    the rendered entry is used as a conservative estimate.
+    """
+    if isinstance(entry, dict):
+        return sum(len(str(value)) for value in entry.values()) + 10
+    return len(str(entry))
+
+
+def summarize_entry(entry) -> str:
+    """Turn an interaction entry into a single short summary line."""
+    if isinstance(entry, dict):
+        if entry.get("action") == "user_query":
+            speaker, text = "user", entry.get("query", "")
+        elif entry.get("action") == "agent_response":
+            speaker, text = entry.get("agent", "agent"), entry.get("response", "")
+        else:
+            speaker = entry.get("action", "interaction")
+            text = ", ".join(f"{k}: {v}" for k, v in entry.items() if k not in ["action", "timestamp"])
+    else:
+        speaker, text = "interaction", str(entry)
+    text = " ".join(str(text).split())
+    if len(text) > INTERACTION_SUMMARY_LINE_CHARS:
+        text = text[:INTERACTION_SUMMARY_LINE_CHARS] + "…"
+    return f"{speaker}: {text}"
+
+
+def compact_interaction_history(history, summary="", token_budget=INTERACTION_HISTORY_TOKEN_BUDGET):
+    """Keep the newest entries within the token budget and fold older ones into the summary.
+
+    The newest entry is always kept. Evicted entries are appended to the summary as
+    one-line digests, and the summary keeps only its most recent lines once it
+    exceeds INTERACTION_SUMMARY_MAX_CHARS.
+
+    Returns:
+        A tuple of (compacted history, updated summary)
+    """
+    kept, used = [], 0
+    for entry in reversed(history):
+        tokens = estimate_tokens(entry)
+        if kept and used + tokens > token_budget:
+            break
+        kept.append(entry)
+        used += tokens
+    kept.reverse()
+
+    evicted = history[: len(history) - len(kept)]
+    if evicted:
+        lines = summary.splitlines() if summary else []
+        lines.extend(summarize_entry(entry) for entry in evicted)
+        while lines and sum(len(line) + 1 for line in lines) > INTERACTION_SUMMARY_MAX_CHARS:
+            lines.pop(0)
+        summary = "\n".join(lines)
+    return kept, summary
+
+
+class TurnScopedSessionService(InMemorySessionService):
+    """In-memory session service that keeps only the current turn's events.
+
+    Conversation context is carried in state (interaction_history and
+    interaction_summary), so when a new user message arrives the events of the
+    previous turns are dropped, and state patches from patch_session_state are
+    applied without being kept in the log. This keeps get_session copies and
+    model contents bounded without re-creating the session, and every turn
+    starts from the root agent as before.
+    """
+
+    async def append_event(self, session, event: Event) -> Event:
+        event = await super().append_event(session=session, event=event)
+        if event.author == "user" and not event.partial:
+            storage_session = self.sessions.get(session.app_name, {}).get(session.user_id, {}).get(session.id)
+            for target in (session, storage_session):
+                if target is None or not target.events:
+                    continue
+                if event.content:
+                    # 新しいメッセージが届いたら以前のターンのイベントを破棄する
+                    target.events = target.events[-1:]
+                elif target.events[-1] is event:
+                    # 状態差分だけのイベントは反映済みなのでログに残さない
+                    target.events.pop()
+        return event
+
+
+async def patch_session_state(session_service, session, state_delta: dict):
+    """Apply a state delta to a session through the session service.
+
+    The delta is recorded as a content-less event, so only the given keys are
+    written and the session itself is never re-created.
+
+    Args:
+        session_service: The session service instance
+        session: The session to patch (as returned by get_session)
+        state_delta: The keys and values to set in state
+    """
+    await session_service.append_event(
+        session,
+        Event(author="user", actions=EventActions(state_delta=state_delta)),
+    )
+
+
+async def update_interaction_history(
+    session_service, app_name, user_id, session_id, entry, token_budget=INTERACTION_HISTORY_TOKEN_BUDGET
+):
     """Add an entry to the interaction history in state.
 
+    The updated history is written as a state delta instead of re-creating the
+    session. The cost per entry still grows with the size of the stored history
+    (get_session copies the whole state); it stays flat over a long conversation
+    because the history is compacted to token_budget.
+
     Args:
         session_service: The session service instance
         app_name: The application name
@@ -41,6 +170,7 @@ async def update_interaction_history(session_service, app_name, user_id, session
         entry: A dictionary containing the interaction data
             - requires 'action' key (e.g., 'user_query', 'agent_response')
             - other keys are flexible depending on the action type
+        token_budget: Token budget for the kept history (older entries move to the summary)
     """
     try:
         # Get current session
@@ -48,43 +178,32 @@ async def update_interaction_history(session_service, app_name, user_id, session
             app_name=app_name, user_id=user_id, session_id=session_id
         )
 
-        # Get current interaction history
-        interaction_history = session.state.get("interaction_history", [])
-
         # Add timestamp if not already present
         if "timestamp" not in entry:
             JST = timezone(timedelta(hours=9))
             entry["timestamp"] = datetime.now(JST)
 
-        # Add the entry to interaction history
-        interaction_history.append(entry)
-
-        # Create updated state
-        updated_state = session.state.copy()
-        updated_state["interaction_history"] = interaction_history
-
-        # Create a new session with updated state
-        await session_service.create_session(
-            app_name=app_name,
-            user_id=user_id,
-            session_id=session_id,
-            state=updated_state,
+        # Add the entry to a new history list (the stored list is never mutated in place),
+        # keeping it within the token budget
+        interaction_history, interaction_summary = compact_interaction_history(
+            session.state.get("interaction_history", []) + [entry],
+            session.state.get("interaction_summary", ""),
+            token_budget,
         )
 
-        # LINEボット環境でローカルステートキャッシュを更新
-        try:
-            from line_bot_server import user_session_states
-            user_session_states[user_id] = updated_state
-            print(f"Updated local session state cache for user {user_id}")
-        except ImportError:
-            # main.py環境では無視
-            pass
+        await patch_session_state(
+            session_service,
+            session,
+            {
+                "interaction_history": interaction_history,
+                "interaction_summary": interaction_summary,
+            },
+        )
 
     except Exception as e:
         print(f"Error updating interaction history: {e}")
 
 
-
 async def add_user_query_to_history(session_service, app_name, user_id, session_id, query):
     """Add a user query to the interaction history."""
     await update_interaction_history(
@@ -177,6 +296,27 @@ async def display_state(
         print(f"Error displaying state: {e}")
 
 
+async def log_session_state(session_service, app_name, user_id, session_id, label):
+    """Output the session state according to the state logger mode.
+
+    In display mode the full state is printed with display_state. In structured
+    mode the session is fetched only for sampled turns, and a size-capped JSON
+    record is handed to the background logging queue.
+    """
+    if state_logger.mode == "display":
+        await display_state(session_service, app_name, user_id, session_id, label)
+        return
+    if not state_logger.should_log():
+        return
+    try:
+        session = await session_service.get_session(
+            app_name=app_name, user_id=user_id, session_id=session_id
+        )
+        state_logger.log_state(label, user_id, session_id, session.state)
+    except Exception as e:
+        print(f"Error logging state: {e}")
+
+
 async def process_agent_response(event):
     """Process and display agent response events."""
     # Only process and display the final response
@@ -205,25 +345,64 @@ async def process_agent_response(event):
 
     return None
 
-def create_content_parts(query: str, image_path: str = None):
+# 画像形式の判定に使うマジックバイト
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+
+
+def detect_image_mime_type(image_data, default: str = "image/jpeg") -> str:
+    """マジックバイトから画像のMIMEタイプを判定する"""
+    header = bytes(image_data[:16])
+    for signature, mime_type in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return mime_type
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    if header[4:8] == b"ftyp" and header[8:12] in (b"heic", b"heix", b"mif1", b"msf1"):
+        return "image/heic"
+    return default
+
+
+def create_content_parts(query: str, image_path: str = None, image_data=None):
+    """問い合わせ文と画像からContentのパーツを作成する
+
+    Args:
+        query: ユーザーの問い合わせ文
+        image_path: 画像ファイルのパス（CLI用）
+        image_data: 画像のバイト列またはmemoryview（LINE Bot用、ファイルを経由しない）
+    """
     parts = [types.Part(text=query)]
-    if image_path:
+    if image_data is None and image_path:
         with open(image_path, "rb") as img_file:
-            image_bytes = img_file.read()
-            image_b64 = base64.b64encode(image_bytes).decode("utf-8")
-            parts.append(
-                types.Part(
-                    inline_data=types.Blob(
-                        mime_type="image/jpeg",  # or image/png
-                        data=image_b64,
-                    )
+            image_data = img_file.read()
+    if image_data:
+        parts.append(
+            types.Part(
+                inline_data=types.Blob(
+                    mime_type=detect_image_mime_type(image_data),
+                    # Blobはbytesのみ受け付けるため、memoryviewの場合はここで1回だけコピーする
+                    data=image_data if isinstance(image_data, bytes) else bytes(image_data),
                 )
             )
+        )
     return parts
 
-async def call_agent_async(runner, user_id, session_id, query:str, image_path:str = None):
-    """Call the agent asynchronously with the user's query."""
-    parts = create_content_parts(query, image_path)
+async def call_agent_async(runner, user_id, session_id, query:str, image_path:str = None, image_data=None):
+    """Call the agent asynchronously with the user's query.
+
+    image_path (CLI) か image_data (LINE Bot、バイト列/memoryview) のどちらかで画像を渡す。
+    画像はモデルに渡す前に前処理（向き補正・縮小・メタデータ削除）する。
+    """
+    if IMAGE_PREPROCESS and (image_data or image_path):
+        if image_data is None:
+            with open(image_path, "rb") as img_file:
+                image_data = img_file.read()
+        image_data = await preprocess_image_async(image_data)
+    parts = create_content_parts(query, image_path, image_data)
     content = types.Content(role="user", parts=parts)
     print(
         f"\n{Colors.BG_GREEN}{Colors.BLACK}{Colors.BOLD}--- Running Query: {query} ---{Colors.RESET}"
@@ -232,7 +411,7 @@ async def call_agent_async(runner, user_id, session_id, query:str, image_path:st
     agent_name = None
 
     # Display state before processing the message
-    await display_state(
+    await log_session_state(
         runner.session_service,
         runner.app_name,
         user_id,
@@ -266,7 +445,7 @@ async def call_agent_async(runner, user_id, session_id, query:str, image_path:st
         )
 
     # Display state after processing the message
-    await display_state(
+    await log_session_state(
         runner.session_service,
         runner.app_name,
         user_id,
@@ -6,6 +6,7 @@ from .sub_agents.recommend_agent import recommend_agent
 from .sub_agents.news_agent import news_agent
 from .sub_agents.look_back_agent import look_back_agent
 from .prompts import INSTRUCTION
+from .router import fast_path_router, record_llm_routing_latency
 from google.adk.agents.callback_context import CallbackContext
 from google.genai import types
 
@@ -36,5 +37,7 @@ root_agent = Agent(
         news_agent,
         look_back_agent
     ],
-    before_agent_callback=check_if_agent_should_run
+    before_agent_callback=check_if_agent_should_run,
+    before_model_callback=fast_path_router,
+    after_model_callback=record_llm_routing_latency,
 )
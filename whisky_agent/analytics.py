@@ -0,0 +1,312 @@
+import json
+from collections import Counter
+from datetime import datetime
+from typing import List, Optional
+
+import numpy as np
+
+from .storage.aggregates import CATEGORY_FIELDS, UNKNOWN_CATEGORY, age_bucket, parse_age, parse_rating
+from .storage.trend_cache import JST, month_key
+
+# カテゴリ別の件数で返す上位の区分数（残りは「その他」にまとめる）
+CATEGORY_TOP_N = 10
+# 銘柄ごとに返すテイスティングノートの特徴数
+NOTES_TOP_N = 3
+NOTE_FIELDS = ("nose", "palate", "finish")
+OTHER_CATEGORY = "その他"
+
+# 時系列の傾向分析で返す期間数、評価の移動平均の期間数、構成比の比較に使う直近の期間数
+TREND_MAX_PERIODS = 12
+TREND_ROLLING_WINDOW = 3
+TREND_RECENT_PERIODS = 3
+TREND_GRANULARITIES = ("month", "quarter")
+
+# 推薦用の好みのプロファイルで返す上位の区分数・好きな特徴の数・銘柄数と、JSONにしたときの最大文字数
+PROFILE_CATEGORY_TOP_N = 5
+PROFILE_NOTES_TOP_N = 5
+PROFILE_BOTTLES_N = 5
+PROFILE_MAX_CHARS = 2000
+# 好きな特徴を数える対象にする評価の下限（該当する記録がない場合は全件から数える）
+FAVOURITE_RATING = 4.0
+
+
+def _top_counts(counter: Counter, top_n: int = CATEGORY_TOP_N) -> dict:
+    """件数の多い順に上位top_n件を返し、残りは「その他」にまとめる"""
+    top = dict(counter.most_common(top_n))
+    rest = sum(counter.values()) - sum(top.values())
+    if rest:
+        top[OTHER_CATEGORY] = rest
+    return top
+
+
+def _top_notes(docs: List[dict], top_n: int = NOTES_TOP_N) -> dict:
+    """複数のドキュメントから、香り・味わい・余韻ごとに多く挙げられた特徴を返す"""
+    notes = {}
+    for field in NOTE_FIELDS:
+        counter = Counter(
+            note for doc in docs for note in (doc.get(field) or []) if isinstance(note, str) and note
+        )
+        if counter:
+            notes[field] = [note for note, _ in counter.most_common(top_n)]
+    return notes
+
+
+def _round(value, digits: int = 2):
+    return None if value is None or np.isnan(value) else round(float(value), digits)
+
+
+def compute_history_analytics(history: List[dict], top_brands: int = 5) -> dict:
+    """ウイスキー履歴から振り返り用の統計を計算する
+
+    評価・熟成年数の統計と銘柄ごとの集計はNumPyの配列演算で行い、LLMには数値だけを渡す。
+
+    Args:
+        history: whisky_collectionのドキュメントのリスト
+        top_brands: 返す上位銘柄の数（評価の平均が高い順）
+    Returns:
+        種類・生産国・地域・熟成年数の区分ごとの件数、評価の分布と統計、上位銘柄とその特徴
+    """
+    count = len(history)
+    result = {"count": count}
+    if not count:
+        return result
+
+    for field in CATEGORY_FIELDS:
+        result[f"by_{field}"] = _top_counts(Counter(doc.get(field) or UNKNOWN_CATEGORY for doc in history))
+    result["by_age_bucket"] = _top_counts(Counter(age_bucket(doc.get("age")) for doc in history))
+
+    ratings = np.array([parse_rating(doc.get("rating")) for doc in history], dtype=float)
+    rated = ~np.isnan(ratings)
+    valid_ratings = ratings[rated]
+    if valid_ratings.size:
+        histogram = np.bincount(np.clip(valid_ratings.astype(int), 1, 5), minlength=6)[1:]
+        result["rating"] = {
+            "count": int(valid_ratings.size),
+            "mean": _round(valid_ratings.mean()),
+            "median": _round(np.median(valid_ratings)),
+            "std": _round(valid_ratings.std()),
+            "histogram": {str(score): int(n) for score, n in zip(range(1, 6), histogram) if n},
+        }
+
+    ages = np.array([parse_age(doc.get("age")) for doc in history], dtype=float)
+    valid_ages = ages[~np.isnan(ages)]
+    if valid_ages.size:
+        result["age"] = {
+            "count": int(valid_ages.size),
+            "mean": _round(valid_ages.mean(), 1),
+            "min": int(valid_ages.min()),
+            "max": int(valid_ages.max()),
+        }
+
+    # 銘柄ごとの件数と評価の平均（np.uniqueの逆引きインデックスでまとめて集計する）
+    brands = np.array([doc.get("brand") or UNKNOWN_CATEGORY for doc in history])
+    names, inverse = np.unique(brands, return_inverse=True)
+    brand_counts = np.bincount(inverse, minlength=names.size)
+    rating_counts = np.bincount(inverse[rated], minlength=names.size)
+    rating_sums = np.bincount(inverse[rated], weights=ratings[rated], minlength=names.size)
+    rating_means = np.divide(
+        rating_sums, rating_counts, out=np.full(names.size, np.nan), where=rating_counts > 0
+    )
+    # 評価の平均が高い順（評価なしは最後）、同じ場合は件数の多い順
+    order = np.lexsort((-brand_counts, -np.nan_to_num(rating_means, nan=-1.0)))
+
+    result["top_brands"] = []
+    for index in order[:top_brands]:
+        brand_docs = [history[i] for i in np.flatnonzero(inverse == index)]
+        result["top_brands"].append(
+            {
+                "brand": str(names[index]),
+                "count": int(brand_counts[index]),
+                "rating_mean": _round(rating_means[index]),
+                **_top_notes(brand_docs),
+            }
+        )
+    return result
+
+
+def _period_key(month: str, granularity: str) -> str:
+    """年月（"2025-06"）を指定の粒度の期間名に変換する"""
+    if granularity == "quarter":
+        year, month_number = month.split("-")
+        return f"{year}-Q{(int(month_number) - 1) // 3 + 1}"
+    return month
+
+
+def _most_common(counter: Counter) -> Optional[str]:
+    return counter.most_common(1)[0][0] if counter else None
+
+
+def _month_range(first: str, last: str) -> List[str]:
+    """firstからlastまでの年月（"2025-06"）を、記録のない月も含めて順に返す"""
+    year, month = map(int, first.split("-"))
+    last_year, last_month = map(int, last.split("-"))
+    months = []
+    while (year, month) <= (last_year, last_month):
+        months.append(f"{year:04d}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def _share_shifts(recent: Counter, earlier: Counter, top_n: int = 3) -> List[dict]:
+    """直近と以前の構成比の差（ポイント）が大きい区分を返す"""
+    recent_total, earlier_total = sum(recent.values()), sum(earlier.values())
+    if not recent_total or not earlier_total:
+        return []
+    shifts = [
+        {
+            "name": name,
+            "recent_share": round(recent[name] / recent_total * 100, 1),
+            "earlier_share": round(earlier[name] / earlier_total * 100, 1),
+        }
+        for name in recent.keys() | earlier.keys()
+    ]
+    for shift in shifts:
+        shift["change_points"] = round(shift["recent_share"] - shift["earlier_share"], 1)
+    shifts.sort(key=lambda shift: abs(shift["change_points"]), reverse=True)
+    return [shift for shift in shifts[:top_n] if shift["change_points"]]
+
+
+def compute_trends(monthly_buckets: dict, granularity: str = "month", current_month: Optional[str] = None) -> dict:
+    """月別集計から期間ごとの件数・評価の推移と、地域・種類の構成比の変化を計算する
+
+    最初の記録の期間から現在の期間までを、記録のない期間も件数0として並べてから計算するため、
+    移動平均や直近と以前の比較が、記録のない期間を飛ばして離れた期間をまたぐことはない。
+
+    Args:
+        monthly_buckets: TrendCacheが返す月別集計
+        granularity: "month"（月別）または"quarter"（四半期別）
+        current_month: 現在の年月（"2025-06"、省略時は日本時間の現在）
+    Returns:
+        直近TREND_MAX_PERIODS期間の推移と、直近TREND_RECENT_PERIODS期間とそれ以前の構成比の変化
+    """
+    if granularity not in TREND_GRANULARITIES:
+        granularity = "month"
+    if not monthly_buckets:
+        return {"granularity": granularity, "periods": []}
+
+    months = sorted(monthly_buckets)
+    current_month = current_month or month_key(datetime.now(JST))
+    periods = {}
+    for month in _month_range(months[0], max(months[-1], current_month)):
+        period = periods.setdefault(
+            _period_key(month, granularity),
+            {"count": 0, "rating_sum": 0.0, "rating_count": 0, "region": Counter(), "whisky_type": Counter()},
+        )
+        bucket = monthly_buckets.get(month)
+        if bucket is None:
+            continue
+        period["count"] += bucket["count"]
+        period["rating_sum"] += bucket["rating_sum"]
+        period["rating_count"] += bucket["rating_count"]
+        period["region"].update(bucket["region"])
+        period["whisky_type"].update(bucket["whisky_type"])
+
+    names = sorted(periods)
+
+    # 評価の移動平均（直近TREND_ROLLING_WINDOW期間の評価の合計÷件数）
+    rating_sums = np.array([periods[name]["rating_sum"] for name in names])
+    rating_counts = np.array([periods[name]["rating_count"] for name in names], dtype=float)
+    window = np.ones(TREND_ROLLING_WINDOW)
+    rolling_sums = np.convolve(rating_sums, window)[: len(names)]
+    rolling_counts = np.convolve(rating_counts, window)[: len(names)]
+    rating_means = np.divide(rating_sums, rating_counts, out=np.full(len(names), np.nan), where=rating_counts > 0)
+    rolling_means = np.divide(
+        rolling_sums, rolling_counts, out=np.full(len(names), np.nan), where=rolling_counts > 0
+    )
+
+    timeline = []
+    for index, name in enumerate(names[-TREND_MAX_PERIODS:], start=max(len(names) - TREND_MAX_PERIODS, 0)):
+        period = periods[name]
+        timeline.append(
+            {
+                "period": name,
+                "count": period["count"],
+                "rating_mean": _round(rating_means[index]),
+                "rolling_rating_mean": _round(rolling_means[index]),
+                "top_region": _most_common(period["region"]),
+                "top_whisky_type": _most_common(period["whisky_type"]),
+            }
+        )
+
+    recent_names, earlier_names = names[-TREND_RECENT_PERIODS:], names[:-TREND_RECENT_PERIODS]
+    recent = {field: sum((periods[name][field] for name in recent_names), Counter()) for field in ("region", "whisky_type")}
+    earlier = {field: sum((periods[name][field] for name in earlier_names), Counter()) for field in ("region", "whisky_type")}
+    return {
+        "granularity": granularity,
+        "periods": timeline,
+        "recent_periods": recent_names,
+        "region_shifts": _share_shifts(recent["region"], earlier["region"]),
+        "whisky_type_shifts": _share_shifts(recent["whisky_type"], earlier["whisky_type"]),
+    }
+
+
+def _bottle(doc: dict) -> dict:
+    """プロファイルに含める1本分の情報（銘柄・地域・種類・評価と代表的な特徴だけ）"""
+    brand = doc.get("brand") or UNKNOWN_CATEGORY
+    notes = [note for field in NOTE_FIELDS for note in (doc.get(field) or []) if isinstance(note, str) and note]
+    bottle = {
+        "whisky": f"{brand} {doc['age']}" if doc.get("age") else brand,
+        "region": doc.get("region"),
+        "whisky_type": doc.get("whisky_type"),
+        "rating": parse_rating(doc.get("rating")),
+        "notes": notes[:NOTES_TOP_N],
+    }
+    return {key: value for key, value in bottle.items() if value}
+
+
+def build_preference_profile(
+    history: List[dict], bottles: int = PROFILE_BOTTLES_N, max_chars: int = PROFILE_MAX_CHARS
+) -> dict:
+    """ウイスキー履歴から、推薦に使う好みのプロファイルを作る
+
+    ドキュメントをそのまま渡す代わりに、地域・種類の上位、好きな特徴、評価の統計、
+    最近の銘柄と評価の高い銘柄だけをまとめ、JSONにしたときにmax_chars文字以内に収める。
+
+    Args:
+        history: whisky_collectionのドキュメントのリスト
+        bottles: 最近の銘柄と評価の高い銘柄として返す数
+        max_chars: プロファイルをJSONにしたときの最大文字数（超える場合は銘柄・特徴の数を減らす）
+    Returns:
+        好みのプロファイル
+    """
+    profile = {"count": len(history)}
+    if not history:
+        return profile
+
+    for field in ("region", "whisky_type"):
+        profile[f"top_{field}"] = _top_counts(
+            Counter(doc.get(field) or UNKNOWN_CATEGORY for doc in history), PROFILE_CATEGORY_TOP_N
+        )
+
+    ratings = [(parse_rating(doc.get("rating")), doc) for doc in history]
+    ratings = [(rating, doc) for rating, doc in ratings if rating is not None]
+    if ratings:
+        values = np.array([rating for rating, _ in ratings])
+        profile["rating"] = {
+            "count": int(values.size),
+            "mean": _round(values.mean()),
+            "min": _round(values.min()),
+            "max": _round(values.max()),
+        }
+
+    favourites = [doc for rating, doc in ratings if rating >= FAVOURITE_RATING] or history
+    profile["favourite_notes"] = _top_notes(favourites, PROFILE_NOTES_TOP_N)
+
+    dated = [doc for doc in history if isinstance(doc.get("updated_at"), datetime)]
+    dated.sort(key=lambda doc: doc["updated_at"], reverse=True)
+    profile["recent"] = [_bottle(doc) for doc in dated[:bottles]]
+    ratings.sort(key=lambda item: item[0], reverse=True)
+    profile["top_rated"] = [_bottle(doc) for _, doc in ratings[:bottles]]
+
+    # 大きすぎる場合は、銘柄を多い方のリストから1件ずつ減らし、それでも収まらなければ特徴を減らす
+    while len(json.dumps(profile, ensure_ascii=False, default=str)) > max_chars:
+        longer = max(("recent", "top_rated"), key=lambda key: len(profile[key]))
+        if profile[longer]:
+            profile[longer].pop()
+        elif any(len(notes) > 1 for notes in profile["favourite_notes"].values()):
+            for notes in profile["favourite_notes"].values():
+                if len(notes) > 1:
+                    notes.pop()
+        else:
+            break
+    return profile
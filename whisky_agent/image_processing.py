@@ -0,0 +1,88 @@
+import asyncio
+import io
+import os
+import time
+from typing import Tuple
+
+from PIL import Image, ImageOps
+
+# モデルに渡す画像の長辺の上限とJPEG品質
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", 1536))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", 85))
+
+# 画像に埋め込まれたメタデータ（EXIF・ICCプロファイル・XMP・IPTC）のImage.infoのキー
+_METADATA_INFO_KEYS = ("exif", "icc_profile", "xmp", "XML:com.adobe.xmp", "photoshop")
+
+
+def _has_metadata(image: Image.Image) -> bool:
+    """EXIF（撮影機器や位置情報）などのメタデータを含むか"""
+    if image.getexif() or any(key in image.info for key in _METADATA_INFO_KEYS):
+        return True
+    # JPEGはJFIF（APP0）以外のアプリケーションセグメントをすべてメタデータとみなす
+    return any(marker != "APP0" for marker, _ in getattr(image, "applist", []))
+
+
+def preprocess_image(image_data, max_edge: int = IMAGE_MAX_EDGE, quality: int = IMAGE_JPEG_QUALITY) -> Tuple[bytes, str]:
+    """モデル呼び出し前に画像を正規化する
+
+    EXIFの向き情報に従って回転し、長辺をmax_edge以下に縮小したうえで、
+    EXIF等のメタデータを含めずにJPEGで再エンコードする。
+    縮小が不要でメタデータを含まず、再エンコードしても元画像より小さくならない場合は元画像をそのまま返す
+    （メタデータを含む場合は小さくならなくても必ず再エンコードしたものを返す）。
+
+    Args:
+        image_data: 元画像のバイト列またはmemoryview
+        max_edge: 縮小後の長辺の上限（ピクセル）
+        quality: JPEGの品質
+    Returns:
+        (再エンコード後のバイト列、または元画像のimage_dataそのもの, MIMEタイプ)
+    """
+    with Image.open(io.BytesIO(image_data)) as image:
+        original_mime_type = image.get_format_mimetype()
+        has_metadata = _has_metadata(image)
+        needs_downscale = max(image.size) > max_edge
+        image = ImageOps.exif_transpose(image)
+        if needs_downscale:
+            image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+
+        # 透過画像は白背景に合成してからRGBに変換する
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+
+        output = io.BytesIO()
+        # exifを渡さないことでメタデータを削除する
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+
+    processed = output.getvalue()
+    if original_mime_type and not (has_metadata or needs_downscale) and len(processed) >= len(image_data):
+        return image_data, original_mime_type
+    return processed, "image/jpeg"
+
+
+async def preprocess_image_async(image_data, max_edge: int = IMAGE_MAX_EDGE, quality: int = IMAGE_JPEG_QUALITY):
+    """preprocess_imageをイベントループ外のスレッドで実行する
+
+    変換に失敗した場合（未対応形式など）は元の画像をそのまま返す。
+    """
+    started_at = time.monotonic()
+    try:
+        processed, _ = await asyncio.to_thread(preprocess_image, image_data, max_edge, quality)
+    except Exception as e:
+        print(f"Image preprocessing skipped: {e}")
+        return image_data
+
+    elapsed_ms = (time.monotonic() - started_at) * 1000
+    if processed is image_data:
+        print(f"Image preprocessing kept original: {len(image_data)} bytes in {elapsed_ms:.0f} ms")
+        return image_data
+    saved = len(image_data) - len(processed)
+    print(
+        f"Image preprocessed: {len(image_data)} -> {len(processed)} bytes "
+        f"(saved {saved} bytes) in {elapsed_ms:.0f} ms"
+    )
+    return processed
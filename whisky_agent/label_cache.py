@@ -0,0 +1,175 @@
+import io
+import os
+import shelve
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from PIL import Image
+
+# ラベル抽出結果キャッシュの設定
+LABEL_CACHE_ENABLED = os.getenv("LABEL_CACHE_ENABLED", "true").lower() == "true"
+LABEL_CACHE_MAX_ENTRIES = int(os.getenv("LABEL_CACHE_MAX_ENTRIES", 1024))
+LABEL_CACHE_MAX_DISTANCE = int(os.getenv("LABEL_CACHE_MAX_DISTANCE", 4))
+# 候補を確定する前に照合する、細かいハッシュ（16×16のdHash、256ビット）のハミング距離の上限
+# （同じ画像の再エンコードや縮小では5以下、同じレイアウトで熟成年数の表記だけが違うラベルでは7以上になる）
+LABEL_CACHE_DETAIL_MAX_DISTANCE = int(os.getenv("LABEL_CACHE_DETAIL_MAX_DISTANCE", 6))
+LABEL_CACHE_PATH = os.getenv("LABEL_CACHE_PATH", "")
+
+DETAIL_HASH_SIZE = 16
+
+
+def _dhash(image: Image.Image, hash_size: int) -> int:
+    """グレースケール画像の差分ハッシュ(dHash)を計算する
+
+    (hash_size+1)×hash_sizeに縮小し、横方向に隣り合う画素の明暗をビット列にする。
+    撮り直しや再エンコードによる細かな違いではほとんど変化しない。
+    """
+    pixels = list(image.resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS).getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def label_hashes(image_data) -> Tuple[int, int]:
+    """キャッシュの検索に使う8×8のdHashと、候補の照合に使う16×16のdHashを返す
+
+    8×8では同じレイアウトのラベル（同じ蒸溜所の熟成年数違いなど）が近い値になりやすいため、
+    文字などの細部を区別できる細かいハッシュでも一致を確かめる。
+    """
+    with Image.open(io.BytesIO(image_data)) as image:
+        grayscale = image.convert("L")
+        return _dhash(grayscale, 8), _dhash(grayscale, DETAIL_HASH_SIZE)
+
+
+class LabelCache:
+    """知覚ハッシュをキーにしたラベル抽出結果のLRUキャッシュ
+
+    ハミング距離がmax_distance以下のハッシュを候補とし、細かいハッシュの距離もdetail_max_distance以下の
+    場合だけほぼ同一のラベルとみなす。
+    store_pathを指定した場合はローカルディスクにも書き込み、起動時に保存の新しい順にmax_entries件を読み戻す
+    （shelveはキーの順序を保証しないため、各エントリに保存の通し番号を持たせる）。
+    ディスクへの書き込みはイベントループをブロックしないよう、専用の1スレッドで順に行う。
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_distance: int = 4,
+        detail_max_distance: int = 6,
+        store_path: str = "",
+    ):
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.detail_max_distance = detail_max_distance
+        self._entries: OrderedDict = OrderedDict()  # 8×8のハッシュ -> {"detail_hash", "info", "seq"}
+        self._seq = 0
+        self._store = None
+        self._store_executor = None
+
+        # メトリクス
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.rejected_matches = 0
+        self.stores = 0
+
+        if store_path:
+            try:
+                self._store = shelve.open(store_path)
+                self._load_store()
+                self._store_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="label-cache")
+                print(f"Label cache loaded {len(self._entries)} entries from {store_path}")
+            except Exception as e:
+                print(f"Label cache store unavailable, using memory only: {e}")
+                self._store = None
+
+    def _load_store(self):
+        entries = []
+        for key in list(self._store.keys()):
+            entry = self._store[key]
+            # 通し番号や細かいハッシュを持たない古い形式のエントリは照合できないため読み込まない
+            if isinstance(entry, dict) and {"seq", "detail_hash", "info"} <= entry.keys():
+                entries.append((int(key, 16), entry))
+        entries.sort(key=lambda item: item[1]["seq"])
+        for image_hash, entry in entries[-self.max_entries:]:
+            self._entries[image_hash] = entry
+        self._seq = entries[-1][1]["seq"] if entries else 0
+
+    def get(self, image_hash: int, detail_hash: int) -> Optional[dict]:
+        """細かいハッシュも一致するエントリのうち、最も近いものを返す（ない場合はNone）"""
+        if image_hash in self._entries:
+            candidates = [(0, image_hash)]
+        else:
+            candidates = []
+            for key in self._entries:
+                distance = (image_hash ^ key).bit_count()
+                if distance <= self.max_distance:
+                    candidates.append((distance, key))
+            candidates.sort()
+
+        best_key, best_distance = None, 0
+        for distance, key in candidates:
+            if (detail_hash ^ self._entries[key]["detail_hash"]).bit_count() <= self.detail_max_distance:
+                best_key, best_distance = key, distance
+                break
+            # 全体の配置は似ているが細部が異なる（同じレイアウトの別の銘柄の可能性がある）
+            self.rejected_matches += 1
+
+        if best_key is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        if best_distance:
+            self.near_hits += 1
+        self._entries.move_to_end(best_key)
+        return dict(self._entries[best_key]["info"])
+
+    def put(self, image_hash: int, detail_hash: int, whisky_info: dict):
+        """抽出結果を保存する（ディスクへの書き込みは待たずに戻る）"""
+        self._seq += 1
+        entry = {"detail_hash": detail_hash, "info": dict(whisky_info), "seq": self._seq}
+        self._entries[image_hash] = entry
+        self._entries.move_to_end(image_hash)
+        evicted = []
+        while len(self._entries) > self.max_entries:
+            evicted.append(self._entries.popitem(last=False)[0])
+        if self._store_executor is not None:
+            self._store_executor.submit(self._write_store, image_hash, dict(entry), evicted)
+        self.stores += 1
+
+    def _write_store(self, image_hash: int, entry: dict, evicted: list):
+        """ディスクに書き込む（shelveはスレッドセーフではないため、専用の1スレッドからのみ呼び出す）"""
+        try:
+            for key in evicted:
+                self._store.pop(f"{key:016x}", None)
+            self._store[f"{image_hash:016x}"] = entry
+            self._store.sync()
+        except Exception as e:
+            print(f"Failed to write label cache store: {e}")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "rejected_matches": self.rejected_matches,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "max_distance": self.max_distance,
+            "detail_max_distance": self.detail_max_distance,
+        }
+
+
+label_cache = LabelCache(
+    max_entries=LABEL_CACHE_MAX_ENTRIES,
+    max_distance=LABEL_CACHE_MAX_DISTANCE,
+    detail_max_distance=LABEL_CACHE_DETAIL_MAX_DISTANCE,
+    store_path=LABEL_CACHE_PATH,
+)
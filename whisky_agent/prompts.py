@@ -78,6 +78,9 @@ INSTRUCTION = """
 - news_agent (ウイスキーニュースを確認)
 - look_back_agent(過去履歴を確認・傾向分析)
 
+**これまでの対話の要約:**
+{interaction_summary?}
+
 **対話履歴:**
 {interaction_history?}
 """
@@ -0,0 +1,186 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from google.adk.agents.callback_context import CallbackContext
+from google.adk.models import LlmRequest, LlmResponse
+from google.genai import types
+
+# LLMによる振り分けの前に、ルールで明らかなケースを直接サブエージェントへ送るか
+FAST_PATH_ROUTER_ENABLED = os.getenv("FAST_PATH_ROUTER_ENABLED", "true").lower() == "true"
+
+# キーワードだけで振り分け先が決まるもの
+KEYWORD_ROUTES = {
+    "news_agent": ("ニュース",),
+    "look_back_agent": ("振り返", "履歴"),
+    "tasting_note_agent": ("テイスティングノート",),
+    "recommend_agent": ("おすすめ", "オススメ"),
+}
+
+# 画像付きのメッセージは、ラベルの解析を明示している場合だけimage_agentへ振り分ける
+# （メニューの画像はrecommend_agentが担当するため、どちらとも取れる場合はLLMに任せる）
+IMAGE_LABEL_KEYWORDS = ("ラベル",)
+IMAGE_MENU_KEYWORDS = ("メニュー",)
+
+# 直前のフェーズ（最後に動いたサブエージェント）に応じて振り分け先が決まるもの
+PHASE_KEYWORDS = ("保存", "修正")
+PHASE_ROUTES = {
+    "image_agent": "image_agent",
+    "tasting_note_agent": "tasting_note_agent",
+}
+
+# 振り分け済みのinvocationと、LLMによる振り分けの開始時刻を覚えておく件数の上限
+MAX_TRACKED_INVOCATIONS = 10000
+
+
+def update_conversation_phase(callback_context: CallbackContext) -> Optional[types.Content]:
+    """サブエージェントの開始時に、現在のフェーズとしてエージェント名を記録する"""
+    callback_context.state["conversation_phase"] = callback_context.agent_name
+    return None
+
+
+def route_message(user_content: Optional[types.Content], conversation_phase: Optional[str]) -> Optional[str]:
+    """ルールで振り分け先のサブエージェント名を決める
+
+    Returns:
+        振り分け先のエージェント名。曖昧な場合はNone（LLMに任せる）
+    """
+    if not user_content or not user_content.parts:
+        return None
+
+    text = "".join(part.text for part in user_content.parts if part.text)
+    if any(part.inline_data for part in user_content.parts):
+        if any(keyword in text for keyword in IMAGE_LABEL_KEYWORDS) and not any(
+            keyword in text for keyword in IMAGE_MENU_KEYWORDS
+        ):
+            return "image_agent"
+        return None
+    candidates = {
+        agent_name
+        for agent_name, keywords in KEYWORD_ROUTES.items()
+        if any(keyword in text for keyword in keywords)
+    }
+    if any(keyword in text for keyword in PHASE_KEYWORDS):
+        phase_route = PHASE_ROUTES.get(conversation_phase)
+        if phase_route is None:
+            return None
+        candidates.add(phase_route)
+
+    if len(candidates) == 1:
+        return candidates.pop()
+    return None
+
+
+class RouterStats:
+    """ルールによる振り分けの効果を集計する"""
+
+    def __init__(self):
+        self.routed = {}
+        self.fallbacks = 0
+        self.llm_routing_seconds = 0.0
+        self.llm_routing_calls = 0
+        self._started_at = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start_llm_routing(self, invocation_id: str):
+        """LLMによる振り分けの開始時刻を記録する（終了が記録されなかった分は古い順に捨てる）"""
+        with self._lock:
+            self._started_at[invocation_id] = time.monotonic()
+            while len(self._started_at) > MAX_TRACKED_INVOCATIONS:
+                self._started_at.popitem(last=False)
+
+    def finish_llm_routing(self, invocation_id: str):
+        """LLMによる振り分けにかかった時間を集計する（開始を記録していない場合は何もしない）"""
+        with self._lock:
+            started_at = self._started_at.pop(invocation_id, None)
+        if started_at is not None:
+            self.llm_routing_seconds += time.monotonic() - started_at
+            self.llm_routing_calls += 1
+
+    def stats(self) -> dict:
+        routed = sum(self.routed.values())
+        total = routed + self.fallbacks
+        avg_llm_ms = self.llm_routing_seconds / self.llm_routing_calls * 1000 if self.llm_routing_calls else None
+        return {
+            "routed": routed,
+            "routed_by_agent": dict(self.routed),
+            "fallbacks": self.fallbacks,
+            "hit_rate": round(routed / total, 4) if total else 0.0,
+            "avg_llm_routing_ms": round(avg_llm_ms, 1) if avg_llm_ms is not None else None,
+            # LLMで振り分けた場合の平均時間から見積もった削減時間
+            "estimated_saved_ms": round(avg_llm_ms * routed, 1) if avg_llm_ms is not None else None,
+        }
+
+
+router_stats = RouterStats()
+
+
+class _InvocationTracker:
+    """ルートエージェントのLLM呼び出しが、そのinvocationで最初のものかを判定する
+
+    サブエージェントが親へ処理を戻すと、同じinvocationの中でルートエージェントのLLM呼び出しが
+    再び行われる。その際にも同じユーザー入力でルールを適用すると同じサブエージェントへ送り返して
+    しまうため、ルールは最初の呼び出しにだけ適用する。
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def first_call(self, invocation_id: str) -> bool:
+        with self._lock:
+            if invocation_id in self._seen:
+                return False
+            self._seen[invocation_id] = None
+            while len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+            return True
+
+
+_invocation_tracker = _InvocationTracker(MAX_TRACKED_INVOCATIONS)
+
+
+def fast_path_router(callback_context: CallbackContext, llm_request: LlmRequest) -> Optional[LlmResponse]:
+    """ルートエージェントのLLM呼び出し前に、明らかなケースはtransfer_to_agentを直接返す
+
+    ルールを適用するのはinvocationの最初の呼び出しだけで、サブエージェントから処理が戻ってきた後の
+    呼び出しは常にLLMに任せる。
+    """
+    if not _invocation_tracker.first_call(callback_context.invocation_id):
+        return None
+
+    target = None
+    if FAST_PATH_ROUTER_ENABLED:
+        target = route_message(
+            callback_context.user_content,
+            callback_context.state.get("conversation_phase"),
+        )
+
+    if target is None:
+        router_stats.fallbacks += 1
+        router_stats.start_llm_routing(callback_context.invocation_id)
+        return None
+
+    print(f"--- Fast-path router: transfer to {target} ---")
+    router_stats.routed[target] = router_stats.routed.get(target, 0) + 1
+    return LlmResponse(
+        content=types.Content(
+            role="model",
+            parts=[
+                types.Part(
+                    function_call=types.FunctionCall(
+                        name="transfer_to_agent", args={"agent_name": target}
+                    )
+                )
+            ],
+        )
+    )
+
+
+def record_llm_routing_latency(callback_context: CallbackContext, llm_response: LlmResponse) -> Optional[LlmResponse]:
+    """LLMによる振り分けにかかった時間を記録する"""
+    router_stats.finish_llm_routing(callback_context.invocation_id)
+    return None
@@ -1,3 +1,29 @@
-from .firestore import FirestoreClient
+from .firestore import (
+    FirestoreClient,
+    firestore_client_pool,
+    firestore_executor,
+    get_firestore_client,
+    get_firestore_client_async,
+    user_sampling_stats,
+)
+from .aggregates import aggregate_stats
+from .cooccurrence import cooccurrence_index
+from .history_cache import history_cache
+from .note_index import note_index
+from .trend_cache import trend_cache
+from .write_behind import write_behind_queue
 
-__all__ = ['FirestoreClient']
+__all__ = [
+    'aggregate_stats',
+    'cooccurrence_index',
+    'FirestoreClient',
+    'firestore_client_pool',
+    'firestore_executor',
+    'get_firestore_client',
+    'get_firestore_client_async',
+    'history_cache',
+    'note_index',
+    'trend_cache',
+    'user_sampling_stats',
+    'write_behind_queue',
+]
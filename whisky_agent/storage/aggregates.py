@@ -0,0 +1,145 @@
+import os
+import re
+from typing import Optional
+
+from google.cloud import firestore
+
+# 保存のたびにユーザーごとの集計ドキュメント(users/{uid}/stats/aggregates)を更新するか
+USER_AGGREGATES_ENABLED = os.getenv("USER_AGGREGATES_ENABLED", "true").lower() == "true"
+
+# 件数を数えるカテゴリ項目
+CATEGORY_FIELDS = ("whisky_type", "country", "region")
+UNKNOWN_CATEGORY = "不明"
+
+# 熟成年数の区分（上限年数, ラベル）
+AGE_BUCKETS = (
+    (10, "〜10年"),
+    (15, "11〜15年"),
+    (20, "16〜20年"),
+)
+AGE_BUCKET_OVER = "21年以上"
+AGE_BUCKET_NON_AGE = "ノンエイジ"
+
+
+class AggregateStats:
+    """集計ドキュメントの更新と読み込みの回数を集計する"""
+
+    def __init__(self):
+        self.transactional_writes = 0
+        self.skipped_uninitialized = 0
+        self.rebuilds = 0
+        self.reads = 0
+
+    def stats(self) -> dict:
+        return {
+            "enabled": USER_AGGREGATES_ENABLED,
+            "transactional_writes": self.transactional_writes,
+            "skipped_uninitialized": self.skipped_uninitialized,
+            "rebuilds": self.rebuilds,
+            "reads": self.reads,
+        }
+
+
+aggregate_stats = AggregateStats()
+
+
+def parse_age(age) -> Optional[int]:
+    """熟成年数の文字列（例: "12年"）から年数を取り出す（ノンエイジや不明はNone）"""
+    match = re.search(r"\d+", str(age or ""))
+    return int(match.group()) if match else None
+
+
+def age_bucket(age) -> str:
+    """熟成年数を集計用の区分に変換する"""
+    years = parse_age(age)
+    if years is None:
+        if "ノンエイジ" in str(age or "") or "NAS" in str(age or "").upper():
+            return AGE_BUCKET_NON_AGE
+        return UNKNOWN_CATEGORY
+    for upper, label in AGE_BUCKETS:
+        if years <= upper:
+            return label
+    return AGE_BUCKET_OVER
+
+
+def parse_rating(rating) -> Optional[float]:
+    try:
+        return float(rating)
+    except (TypeError, ValueError):
+        return None
+
+
+def rating_bucket(rating: float) -> str:
+    """評価(1-5)をヒストグラムの区分（整数部分）に変換する"""
+    return str(min(5, max(1, int(rating))))
+
+
+def contribution(doc: Optional[dict]) -> dict:
+    """1件のウイスキードキュメントが集計に与える寄与を (フィールドのパス) -> 値 で返す"""
+    if not doc:
+        return {}
+    values = {("count",): 1}
+    for field in CATEGORY_FIELDS:
+        values[(field, doc.get(field) or UNKNOWN_CATEGORY)] = 1
+    values[("age_bucket", age_bucket(doc.get("age")))] = 1
+
+    years = parse_age(doc.get("age"))
+    if years is not None:
+        values[("age_count",)] = 1
+        values[("age_sum",)] = years
+
+    rating = parse_rating(doc.get("rating"))
+    if rating is not None:
+        values[("rating_histogram", rating_bucket(rating))] = 1
+        values[("rating_count",)] = 1
+        values[("rating_sum",)] = rating
+    return values
+
+
+def aggregate_deltas(old_doc: Optional[dict], new_doc: Optional[dict]) -> dict:
+    """保存前後のドキュメントから、集計ドキュメントに加える増分をIncrementの入れ子の辞書で返す"""
+    old_values, new_values = contribution(old_doc), contribution(new_doc)
+    deltas = {}
+    for path in old_values.keys() | new_values.keys():
+        delta = new_values.get(path, 0) - old_values.get(path, 0)
+        if not delta:
+            continue
+        target = deltas
+        for key in path[:-1]:
+            target = target.setdefault(key, {})
+        target[path[-1]] = firestore.Increment(delta)
+    return deltas
+
+
+def build_aggregates(docs) -> dict:
+    """コレクション全体から集計ドキュメントを作り直す（既存ユーザーの初回読み込み用）"""
+    aggregates = {}
+    for doc in docs:
+        for path, value in contribution(doc).items():
+            target = aggregates
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = target.get(path[-1], 0) + value
+    return aggregates
+
+
+def summarize_aggregates(aggregates: dict) -> dict:
+    """集計ドキュメントから平均値を計算し、ツールが返す形に整える"""
+    rating_count = aggregates.get("rating_count", 0)
+    age_count = aggregates.get("age_count", 0)
+
+    def counts(field):
+        # 件数が0になった区分は除き、多い順に並べる
+        values = {key: value for key, value in aggregates.get(field, {}).items() if value}
+        return dict(sorted(values.items(), key=lambda item: item[1], reverse=True))
+
+    return {
+        "count": aggregates.get("count", 0),
+        "whisky_type": counts("whisky_type"),
+        "country": counts("country"),
+        "region": counts("region"),
+        "age_bucket": counts("age_bucket"),
+        "rating_histogram": {key: value for key, value in sorted(aggregates.get("rating_histogram", {}).items()) if value},
+        "rating_mean": round(aggregates.get("rating_sum", 0) / rating_count, 2) if rating_count else None,
+        "age_mean": round(aggregates.get("age_sum", 0) / age_count, 1) if age_count else None,
+    }
@@ -0,0 +1,147 @@
+import math
+import os
+import unicodedata
+from collections import Counter, defaultdict
+from typing import List, Optional
+
+from .aggregates import parse_age
+from .index_base import WHISKY_INDEX_REBUILD_SECONDS, RebuildableIndex
+
+# 共起インデックスによる推薦で返す件数
+COOCCURRENCE_TOP_N = int(os.getenv("COOCCURRENCE_TOP_N", 5))
+
+
+def item_key(brand, age) -> Optional[str]:
+    """銘柄と熟成年数から、表記ゆれを吸収したアイテムのキーを作る（銘柄がない場合はNone）"""
+    brand = unicodedata.normalize("NFKC", str(brand or "")).lower()
+    brand = "".join(brand.split())
+    if not brand:
+        return None
+    years = parse_age(age)
+    return f"{brand}|{years if years is not None else 'nas'}"
+
+
+def item_label(brand, age) -> str:
+    """推薦結果に表示する銘柄名"""
+    return f"{brand} {age}".strip() if age else str(brand)
+
+
+class CooccurrenceIndex(RebuildableIndex):
+    """全ユーザーのwhisky_collectionから作るアイテム同士の共起インデックス
+
+    「Xを記録した人はYも記録している」人数をアイテムのペアごとに数える。
+    """
+
+    SCAN_FIELDS = ("brand", "age")
+
+    def __init__(self, rebuild_interval: float = 3600.0):
+        super().__init__(rebuild_interval)
+        self._reset()
+        self.queries = 0
+
+    def _reset(self):
+        self._pairs = defaultdict(Counter)  # key -> Counter(共起するkey -> ユーザー数)
+        self._popularity = Counter()  # key -> 記録したユーザー数
+        self._user_items = defaultdict(Counter)  # user_id -> Counter(key -> ドキュメント数)
+        self._user_docs = defaultdict(dict)  # user_id -> {whisky_id: key}
+        self._labels = {}
+
+    def _new_empty(self) -> "CooccurrenceIndex":
+        return CooccurrenceIndex(self.rebuild_interval)
+
+    def _swap_from(self, fresh: "CooccurrenceIndex"):
+        self._pairs, self._popularity = fresh._pairs, fresh._popularity
+        self._user_items, self._user_docs, self._labels = fresh._user_items, fresh._user_docs, fresh._labels
+
+    def _add_user_item(self, user_id: str, key: str):
+        items = self._user_items[user_id]
+        items[key] += 1
+        if items[key] > 1:
+            return
+        self._popularity[key] += 1
+        for other in items:
+            if other != key:
+                self._pairs[key][other] += 1
+                self._pairs[other][key] += 1
+
+    def _remove_user_item(self, user_id: str, key: str):
+        items = self._user_items[user_id]
+        items[key] -= 1
+        if items[key] > 0:
+            return
+        del items[key]
+        self._popularity[key] -= 1
+        if self._popularity[key] <= 0:
+            del self._popularity[key]
+        for other in items:
+            self._pairs[key][other] -= 1
+            self._pairs[other][key] -= 1
+            if self._pairs[key][other] <= 0:
+                del self._pairs[key][other]
+                del self._pairs[other][key]
+
+    def _set_doc(self, user_id: str, whisky_id: str, brand, age) -> bool:
+        """1件のドキュメントのアイテムを差し替える（銘柄が消された場合は以前のアイテムを取り除く）"""
+        key = item_key(brand, age)
+        old_key = self._user_docs[user_id].get(whisky_id)
+        if key == old_key:
+            return False
+        if old_key is not None:
+            self._remove_user_item(user_id, old_key)
+            del self._user_docs[user_id][whisky_id]
+        if key is None:
+            return old_key is not None
+        self._user_docs[user_id][whisky_id] = key
+        self._labels[key] = item_label(brand, age)
+        self._add_user_item(user_id, key)
+        return True
+
+    def _apply(self, user_id: str, whisky_id: str, data: dict) -> bool:
+        # 銘柄を含まない保存（テイスティングノートだけの更新など）はアイテムを変えない
+        if "brand" not in data:
+            return False
+        return self._set_doc(user_id, whisky_id, data.get("brand"), data.get("age"))
+
+    def recommend(self, item_keys: List[str], top_n: int = 5, exclude: Optional[set] = None) -> List[dict]:
+        """指定したアイテム群と一緒に記録されているアイテムを、共起の強い順に返す
+
+        スコアは共起ユーザー数をそれぞれの記録ユーザー数で正規化した値（コサイン類似度）の合計。
+        """
+        exclude = set(item_keys) | (exclude or set())
+        with self._lock:
+            self.queries += 1
+            scores, co_counts, reasons = Counter(), Counter(), {}
+            for key in item_keys:
+                base_popularity = self._popularity.get(key, 0)
+                if not base_popularity:
+                    continue
+                for other, count in self._pairs.get(key, {}).items():
+                    if other in exclude:
+                        continue
+                    score = count / math.sqrt(base_popularity * self._popularity[other])
+                    scores[other] += score
+                    co_counts[other] += count
+                    if score > reasons.get(other, (None, 0.0))[1]:
+                        reasons[other] = (self._labels.get(key, key), score)
+
+            return [
+                {
+                    "whisky": self._labels.get(key, key),
+                    "score": round(score, 3),
+                    "co_logged_users": co_counts[key],
+                    "because_you_logged": reasons[key][0],
+                }
+                for key, score in scores.most_common(top_n)
+            ]
+
+    def stats(self) -> dict:
+        return {
+            **self._base_stats(),
+            "items": len(self._popularity),
+            "users": len(self._user_items),
+            "pairs": sum(len(others) for others in self._pairs.values()) // 2,
+            "queries": self.queries,
+        }
+
+
+cooccurrence_index = CooccurrenceIndex(rebuild_interval=WHISKY_INDEX_REBUILD_SECONDS)
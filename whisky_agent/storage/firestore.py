@@ -1,11 +1,119 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import firestore
+from google.cloud.firestore import FieldFilter
 from datetime import datetime, timezone, timedelta
 from dotenv import load_dotenv
 import os
 import random
+import threading
+import time
+from typing import List, Optional, Tuple
+from .aggregates import (
+    USER_AGGREGATES_ENABLED,
+    aggregate_deltas,
+    aggregate_stats,
+    build_aggregates,
+    summarize_aggregates,
+)
+from .cooccurrence import COOCCURRENCE_TOP_N, cooccurrence_index, item_key
+from .history_cache import HISTORY_CACHE_ENABLED, history_cache
+from .index_base import rebuild_indexes
+from .note_index import NOTE_INDEX_TOP_K, note_index
+from .trend_cache import trend_cache
+from .write_behind import WRITE_BEHIND_ENABLED, write_behind_queue
 
 load_dotenv()  # .env を読み込む
 
+# 初期化に失敗した場合、再試行までの待ち時間（失敗が続くごとに倍にし、上限で止める）
+FIRESTORE_INIT_BACKOFF_SECONDS = float(os.getenv("FIRESTORE_INIT_BACKOFF_SECONDS", 5))
+FIRESTORE_INIT_BACKOFF_MAX_SECONDS = float(os.getenv("FIRESTORE_INIT_BACKOFF_MAX_SECONDS", 300))
+
+# 履歴をページ単位で読み込む際の1ページの件数
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", 50))
+
+# ランダムサンプリング用にusers/{uid}ドキュメントへ書き込むキーのフィールド名
+USER_RANDOM_KEY_FIELD = "random_key"
+# 既存ユーザーへのキーの一括付与が完了したことを記録するドキュメントとフィールド
+USER_SAMPLING_META_COLLECTION = "meta"
+USER_SAMPLING_META_DOCUMENT = "user_sampling"
+RANDOM_KEY_BACKFILLED_FIELD = "random_key_backfilled_at"
+
+# 他のユーザーの履歴を参考にする際に、1回でサンプリングするユーザー数の上限
+OTHER_USERS_MAX_SAMPLE = int(os.getenv("OTHER_USERS_MAX_SAMPLE", 3))
+
+# 同期APIのFirestore呼び出しを実行する専用スレッド数（イベントループをブロックしないため）
+FIRESTORE_EXECUTOR_WORKERS = int(os.getenv("FIRESTORE_EXECUTOR_WORKERS", 8))
+
+
+class FirestoreExecutor:
+    """Firestoreの同期呼び出しを専用のスレッドプールで実行する
+
+    asyncio.to_threadの共有プールを使わないことで、画像処理など他のスレッド処理と
+    スレッドを取り合わずに、Firestoreの同時実行数を個別に制限できる。
+    """
+
+    def __init__(self, max_workers: int = 8):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="firestore")
+
+        # メトリクス
+        self.calls = 0
+        self.failures = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.total_seconds = 0.0
+
+    async def run(self, func, *args, **kwargs):
+        """同期関数をスレッドプールで実行し、完了を待つ"""
+        loop = asyncio.get_running_loop()
+        started_at = time.monotonic()
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return await loop.run_in_executor(self._executor, lambda: func(*args, **kwargs))
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            self.total_seconds += time.monotonic() - started_at
+
+    def stats(self) -> dict:
+        return {
+            "max_workers": self.max_workers,
+            "calls": self.calls,
+            "failures": self.failures,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "avg_ms": round(self.total_seconds / self.calls * 1000, 1) if self.calls else 0.0,
+        }
+
+
+firestore_executor = FirestoreExecutor(max_workers=FIRESTORE_EXECUTOR_WORKERS)
+
+class UserSamplingStats:
+    """他ユーザーのランダムサンプリングの実行状況を集計する"""
+
+    def __init__(self):
+        self.index_samples = 0
+        self.backfill_runs = 0
+        self.backfilled_users = 0
+        self.indexed_users = 0
+
+    def stats(self) -> dict:
+        return {
+            "index_samples": self.index_samples,
+            "backfill_runs": self.backfill_runs,
+            "backfilled_users": self.backfilled_users,
+            "indexed_users": self.indexed_users,
+        }
+
+
+user_sampling_stats = UserSamplingStats()
+
+
 class FirestoreClient:
     """Firestoreとのデータ連携を管理するクラス"""
 
@@ -22,11 +130,21 @@ class FirestoreClient:
                 print("Removed GOOGLE_APPLICATION_CREDENTIALS for Cloud Run environment")
 
             self.db = firestore.Client(project=project_id)
+            # このプロセスでrandom_keyの存在を確認済みのユーザー
+            self._indexed_user_ids = set()
+            self._random_key_backfilled = False
+            self._backfill_lock = threading.Lock()
+            # バックグラウンドで実行中のインメモリインデックス（共起・テイスティングノート）の作成
+            self._index_task = None
             print(f"Firestore initialized with project: {project_id}")
         except Exception as e:
             print(f"Firestore initialization failed: {e}")
             # フォールバック: Firestoreを無効化
             self.db = None
+            self._indexed_user_ids = set()
+            self._random_key_backfilled = False
+            self._backfill_lock = threading.Lock()
+            self._index_task = None
 
     def save_whisky_info(self, user_id: str, whisky_id: str, whisky_info: dict):
         """
@@ -46,10 +164,122 @@ class FirestoreClient:
             whisky_info_with_timestamp = whisky_info.copy()
             whisky_info_with_timestamp["updated_at"] = datetime.now(JST)
             doc_ref = self.db.collection("users").document(user_id).collection("whisky_collection").document(whisky_id)
-            doc_ref.set(whisky_info_with_timestamp, merge=True)
+            self._write_whisky_doc(user_id, doc_ref, whisky_info_with_timestamp)
+            self._patch_caches(user_id, whisky_id, whisky_info_with_timestamp)
+            self._ensure_user_random_key(user_id)
             print(f"Whisky info saved for user {user_id}, whisky {whisky_id}")
         except Exception as e:
             print(f"Failed to save whisky info: {e}")
+            # 失敗した書き込みがコミットされたかは分からないため、次回はFirestoreから読み直す
+            history_cache.invalidate(user_id)
+
+    async def save_whisky_info_async(self, user_id: str, whisky_id: str, whisky_info: dict):
+        """save_whisky_infoを専用スレッドで実行する（イベントループをブロックしない）
+
+        FIRESTORE_WRITE_BEHINDが有効でUSER_AGGREGATES_ENABLEDが無効な場合は書き込みキューに積んだ時点で戻り、
+        他の書き込みとまとめてバッチコミットする（キューが満杯の場合は直接書き込む）。
+        それ以外の場合はコミットが終わってから戻る。
+        キューはメモリ上にしかないため、コミット前にプロセスが停止すると保存は失われる。
+        キャッシュにはコミット後に反映するため、それまでの間（FIRESTORE_FLUSH_INTERVAL_MS程度）は保存前の内容を返す。
+        """
+        if WRITE_BEHIND_ENABLED and self.db is not None:
+            JST = timezone(timedelta(hours=9))
+            whisky_info_with_timestamp = whisky_info.copy()
+            whisky_info_with_timestamp["updated_at"] = datetime.now(JST)
+            doc_ref = self.db.collection("users").document(user_id).collection("whisky_collection").document(whisky_id)
+            # キャッシュとインデックスはコミットに成功してから反映する（破棄された保存を反映しないため）
+            on_commit = lambda: self._patch_caches(user_id, whisky_id, whisky_info_with_timestamp)
+            on_failure = lambda: history_cache.invalidate(user_id)
+            if write_behind_queue.enqueue(
+                self.db, doc_ref, whisky_info_with_timestamp, on_commit=on_commit, on_failure=on_failure
+            ):
+                if user_id not in self._indexed_user_ids:
+                    # 既にキーがある場合は書き換えないよう、トランザクションで確認してから書き込む
+                    user_ref = self.db.collection("users").document(user_id)
+                    write_behind_queue.enqueue(
+                        self.db, user_ref, {}, writer=lambda data: self._ensure_user_random_key(user_id)
+                    )
+                print(f"Whisky info queued for user {user_id}, whisky {whisky_id}")
+                return
+        await firestore_executor.run(self.save_whisky_info, user_id, whisky_id, whisky_info)
+
+    def _patch_caches(self, user_id: str, whisky_id: str, data: dict):
+        """保存した内容を履歴・時系列のキャッシュと共起・テイスティングノートのインデックスに反映する"""
+        history_cache.patch(user_id, whisky_id, data)
+        trend_cache.apply(user_id, whisky_id, data)
+        cooccurrence_index.patch(user_id, whisky_id, data)
+        note_index.patch(user_id, whisky_id, data)
+
+    def _aggregates_ref(self, user_id: str):
+        return self.db.collection("users").document(user_id).collection("stats").document("aggregates")
+
+    def _write_whisky_doc(self, user_id: str, doc_ref, data: dict):
+        """ウイスキードキュメントをmerge書き込みし、有効な場合は集計ドキュメントも同じトランザクションで更新する
+
+        トランザクションで書き込む場合は、ドキュメントがまだなければ記録した日時としてcreated_atも書き込む
+        （USER_AGGREGATES_ENABLEDが無効な場合は読み込みを増やさないよう書き込まない）。
+        """
+        if not USER_AGGREGATES_ENABLED:
+            doc_ref.set(data, merge=True)
+            return
+
+        aggregates_ref = self._aggregates_ref(user_id)
+
+        @firestore.transactional
+        def write(transaction):
+            snapshot = doc_ref.get(transaction=transaction)
+            aggregates_exists = aggregates_ref.get(transaction=transaction).exists
+            old_doc = snapshot.to_dict() if snapshot.exists else None
+            doc_data = data if snapshot.exists else {**data, "created_at": data["updated_at"]}
+            transaction.set(doc_ref, doc_data, merge=True)
+            if not aggregates_exists:
+                # 集計ドキュメントがまだない場合は、初回の読み込み時にコレクション全体から作成する
+                return False
+            deltas = aggregate_deltas(old_doc, {**(old_doc or {}), **data})
+            if deltas:
+                transaction.set(aggregates_ref, deltas, merge=True)
+            return True
+
+        # 競合で再試行された分を数えないよう、コミットに成功してからメトリクスを更新する
+        aggregates_updated = write(self.db.transaction())
+        aggregate_stats.transactional_writes += 1
+        if not aggregates_updated:
+            aggregate_stats.skipped_uninitialized += 1
+
+    def _load_user_aggregates(self, user_id: str) -> dict:
+        """集計ドキュメントを読み込む（存在しない場合はコレクション全体から作成する）内部メソッド"""
+        aggregates_ref = self._aggregates_ref(user_id)
+        snapshot = aggregates_ref.get()
+        aggregate_stats.reads += 1
+        if snapshot.exists:
+            return snapshot.to_dict()
+
+        whisky_collection_ref = self.db.collection("users").document(user_id).collection("whisky_collection")
+
+        @firestore.transactional
+        def rebuild(transaction):
+            docs = [doc.to_dict() for doc in whisky_collection_ref.stream(transaction=transaction)]
+            aggregates = build_aggregates(docs)
+            transaction.set(aggregates_ref, aggregates)
+            return aggregates
+
+        aggregates = rebuild(self.db.transaction())
+        aggregate_stats.rebuilds += 1
+        print(f"Rebuilt aggregates for user {user_id}")
+        return aggregates
+
+    async def get_user_aggregates(self, user_id: str) -> dict:
+        """ユーザーの集計（種類・国・地域・熟成年数別の件数、評価の分布と平均）を取得する"""
+        if self.db is None:
+            print("Firestore is not available, returning empty aggregates")
+            return summarize_aggregates({})
+
+        try:
+            aggregates = await firestore_executor.run(self._load_user_aggregates, user_id)
+        except Exception as e:
+            print(f"Failed to get user aggregates: {e}")
+            return summarize_aggregates({})
+        return summarize_aggregates(aggregates)
 
     def _get_whisky_collection_for_user(self, user_id: str) -> list:
         """指定されたユーザーのウイスキーコレクションを取得する内部メソッド"""
@@ -62,34 +292,338 @@ class FirestoreClient:
             history.append(whisky_data)
         return history
 
-    def _get_random_user_id(self, exclude_user_id: str = None) -> str:
-        """ランダムなユーザーIDを取得する内部メソッド（指定されたユーザーIDを除外）"""
+    def _get_whisky_collection_changes(self, user_id: str, since: datetime) -> list:
+        """指定時刻より後に更新されたドキュメントだけを取得する内部メソッド"""
+        whisky_collection_ref = self.db.collection("users").document(user_id).collection("whisky_collection")
+        docs = whisky_collection_ref.where(filter=FieldFilter("updated_at", ">", since)).stream()
+        changed = []
+        for doc in docs:
+            whisky_data = doc.to_dict()
+            whisky_data['id'] = doc.id
+            changed.append(whisky_data)
+        return changed
+
+    def _load_whisky_collection(self, user_id: str) -> list:
+        """キャッシュを優先してユーザーのウイスキーコレクションを取得する
+
+        キャッシュが期限切れの場合は、前回の同期以降に更新されたドキュメントだけを読み込んでマージする。
+        """
+        if not HISTORY_CACHE_ENABLED:
+            return self._get_whisky_collection_for_user(user_id)
+
+        history = history_cache.get(user_id)
+        if history is not None:
+            return history
+
+        cursor = history_cache.sync_cursor(user_id)
+        if cursor is not None:
+            return history_cache.merge(user_id, self._get_whisky_collection_changes(user_id, cursor))
+
+        history = self._get_whisky_collection_for_user(user_id)
+        history_cache.put(user_id, history)
+        return history
+
+    def _query_whisky_collection_page(
+        self,
+        user_id: str,
+        fields: Optional[List[str]] = None,
+        page_size: int = HISTORY_PAGE_SIZE,
+        start_after: Optional[dict] = None,
+        descending: bool = True,
+    ) -> Tuple[list, Optional[dict]]:
+        """updated_at順（同じ場合はドキュメントID順）に1ページ分のドキュメントを取得する内部メソッド
+
+        Args:
+            fields: 取得するフィールド（Noneの場合は全フィールド）
+            page_size: 取得する最大件数
+            start_after: 前ページの最後の位置 {"updated_at": ..., "__name__": ドキュメントID}
+            descending: Trueの場合は新しい順
+        Returns:
+            (ドキュメントのリスト, 最後のドキュメントの位置)
+        """
+        whisky_collection_ref = self.db.collection("users").document(user_id).collection("whisky_collection")
+        direction = firestore.Query.DESCENDING if descending else firestore.Query.ASCENDING
+        query = whisky_collection_ref.order_by("updated_at", direction=direction).order_by("__name__", direction=direction)
+        if fields:
+            # カーソルの位置を作るためupdated_atは常に読み込み、指定されていない場合は結果から除く
+            query = query.select(list(dict.fromkeys([*fields, "updated_at"])))
+        if start_after is not None:
+            query = query.start_after(start_after)
+
+        page, last_position = [], None
+        for doc in query.limit(page_size).stream():
+            whisky_data = doc.to_dict()
+            last_position = {"updated_at": whisky_data.get("updated_at"), "__name__": doc.id}
+            if fields and "updated_at" not in fields:
+                whisky_data.pop("updated_at", None)
+            whisky_data['id'] = doc.id
+            page.append(whisky_data)
+        return page, last_position
+
+    @staticmethod
+    def _encode_history_cursor(position: dict) -> str:
+        """ページの位置を、次ページの取得に渡す文字列のカーソルにする（"updated_atのISO形式|ドキュメントID"）"""
+        return f"{position['updated_at'].isoformat()}|{position['__name__']}"
+
+    @staticmethod
+    def _decode_history_cursor(cursor: str) -> dict:
+        updated_at, doc_id = cursor.split("|", 1)
+        return {"updated_at": datetime.fromisoformat(updated_at), "__name__": doc_id}
+
+    async def get_whisky_history_page(
+        self,
+        user_id: str,
+        fields: Optional[List[str]] = None,
+        page_size: int = HISTORY_PAGE_SIZE,
+        cursor: Optional[str] = None,
+        descending: bool = True,
+    ) -> Tuple[list, Optional[str]]:
+        """履歴を1ページ分取得する
+
+        Args:
+            user_id: ユーザーID
+            fields: 取得するフィールド（Noneの場合は全フィールド）
+            page_size: 1ページの件数
+            cursor: 前ページが返した次ページのカーソル（最初のページはNone）。
+                ドキュメントではなくupdated_atとIDを持つため、途中でドキュメントが更新されても位置はずれない
+            descending: Trueの場合は新しい順
+        Returns:
+            (ドキュメントのリスト, 次ページのカーソル。最後のページの場合はNone)
+        """
+        if self.db is None:
+            print("Firestore is not available, returning empty history")
+            return [], None
+
+        try:
+            start_after = self._decode_history_cursor(cursor) if cursor else None
+            page, last_position = await firestore_executor.run(
+                self._query_whisky_collection_page, user_id, fields, page_size, start_after, descending
+            )
+        except Exception as e:
+            print(f"Failed to get whisky history page: {e}")
+            return [], None
+        if last_position is None or len(page) < page_size:
+            return page, None
+        return page, self._encode_history_cursor(last_position)
+
+    def _ensure_user_random_key(self, user_id: str):
+        """サンプリング用のrandom_keyがusers/{uid}になければ書き込む（確認はプロセス内で1ユーザー1回）
+
+        プロセスの再起動のたびにキーが変わらないよう、既存のキーの確認と書き込みを同じトランザクションで行う。
+        """
+        if user_id in self._indexed_user_ids:
+            return
+        user_ref = self.db.collection("users").document(user_id)
+
+        @firestore.transactional
+        def write(transaction):
+            snapshot = user_ref.get([USER_RANDOM_KEY_FIELD], transaction=transaction)
+            if (snapshot.to_dict() or {}).get(USER_RANDOM_KEY_FIELD) is not None:
+                return False
+            transaction.set(user_ref, {USER_RANDOM_KEY_FIELD: random.random()}, merge=True)
+            return True
+
+        try:
+            if write(self.db.transaction()):
+                user_sampling_stats.indexed_users += 1
+            self._indexed_user_ids.add(user_id)
+        except Exception as e:
+            print(f"Failed to write sampling key for user {user_id}: {e}")
+
+    def _query_random_key_range(self, start: float, end: float, limit: int) -> list:
+        """random_keyが[start, end)のユーザーIDをキー順に取得する内部メソッド"""
+        query = (
+            self.db.collection("users")
+            .where(filter=FieldFilter(USER_RANDOM_KEY_FIELD, ">=", start))
+            .where(filter=FieldFilter(USER_RANDOM_KEY_FIELD, "<", end))
+            .order_by(USER_RANDOM_KEY_FIELD)
+            .select([USER_RANDOM_KEY_FIELD])
+            .limit(limit)
+        )
+        return [doc.id for doc in query.stream()]
+
+    def _sample_user_ids(self, num_users: int = 1, exclude_user_id: str = None) -> list:
+        """random_keyのインデックスを使ってユーザーIDをサンプリングする内部メソッド
+
+        ランダムな位置から最大num_users+1件（除外するユーザー分）を読み、足りなければ先頭に折り返す。
+        読み込む件数はユーザー数によらず一定。既存ユーザーへのキーの一括付与が完了していない場合は、
+        先に一括付与を行ってからインデックスを使う（通常はデプロイ時にbackfill_user_random_keysで済ませておく）。
+        """
+        if not self._random_key_backfill_completed():
+            with self._backfill_lock:
+                if not self._random_key_backfill_completed():
+                    user_sampling_stats.backfill_runs += 1
+                    self.backfill_user_random_keys()
+
+        pivot = random.random()
+        limit = num_users + 1
+        user_ids = self._query_random_key_range(pivot, 1.0, limit)
+        if len(user_ids) < limit:
+            user_ids += self._query_random_key_range(0.0, pivot, limit - len(user_ids))
+        user_sampling_stats.index_samples += 1
+        return [uid for uid in dict.fromkeys(user_ids) if uid != exclude_user_id][:num_users]
+
+    def _sampling_meta_ref(self):
+        return self.db.collection(USER_SAMPLING_META_COLLECTION).document(USER_SAMPLING_META_DOCUMENT)
+
+    def _random_key_backfill_completed(self) -> bool:
+        """既存ユーザーへのキーの一括付与が完了しているか（完了を確認した後はFirestoreを読まない）"""
+        if not self._random_key_backfilled:
+            snapshot = self._sampling_meta_ref().get([RANDOM_KEY_BACKFILLED_FIELD])
+            self._random_key_backfilled = (snapshot.to_dict() or {}).get(RANDOM_KEY_BACKFILLED_FIELD) is not None
+        return self._random_key_backfilled
+
+    def backfill_user_random_keys(self, user_ids: list = None) -> int:
+        """random_keyを持たないユーザーにキーを書き込む
+
+        全ユーザーを対象にした場合は、完了したことをmeta/user_samplingに記録する。
+
+        Args:
+            user_ids: 対象のユーザーID（Noneの場合はusersコレクションを全件列挙する）
+        Returns:
+            書き込んだユーザー数
+        """
+        if self.db is None:
+            return 0
         users_ref = self.db.collection("users")
-        user_docs = users_ref.list_documents()
-        user_ids = [doc.id for doc in user_docs]
+        all_users = user_ids is None
+        if all_users:
+            user_ids = [doc.id for doc in users_ref.list_documents()]
+
+        written = 0
+        for start in range(0, len(user_ids), 500):
+            refs = [users_ref.document(user_id) for user_id in user_ids[start:start + 500]]
+            batch, batch_size = self.db.batch(), 0
+            for snapshot in self.db.get_all(refs, field_paths=[USER_RANDOM_KEY_FIELD]):
+                self._indexed_user_ids.add(snapshot.id)
+                if (snapshot.to_dict() or {}).get(USER_RANDOM_KEY_FIELD) is not None:
+                    continue
+                batch.set(snapshot.reference, {USER_RANDOM_KEY_FIELD: random.random()}, merge=True)
+                batch_size += 1
+            if batch_size:
+                batch.commit()
+            written += batch_size
+
+        if all_users:
+            self._sampling_meta_ref().set({RANDOM_KEY_BACKFILLED_FIELD: firestore.SERVER_TIMESTAMP}, merge=True)
+            self._random_key_backfilled = True
+        user_sampling_stats.backfilled_users += written
+        print(f"Backfilled sampling keys for {written} users")
+        return written
 
+    def _get_random_user_id(self, exclude_user_id: str = None) -> str:
+        """ランダムなユーザーIDを取得する内部メソッド（指定されたユーザーIDを除外）"""
+        user_ids = self._sample_user_ids(1, exclude_user_id)
         if not user_ids:
-            raise ValueError("No users found in Firestore")
+            raise ValueError("No other users found in Firestore")
+        return user_ids[0]
 
-        # 除外するユーザーIDがある場合は、それ以外のユーザーIDから選択
-        if exclude_user_id and exclude_user_id in user_ids:
-            available_user_ids = [uid for uid in user_ids if uid != exclude_user_id]
-            if not available_user_ids:
-                raise ValueError("No other users found in Firestore")
-            return random.choice(available_user_ids)
+    async def get_other_users_history(self, exclude_user_id: str = None, num_users: int = 1) -> list:
+        """他のユーザーを複数人ランダムに選び、それぞれの履歴を取得する
+
+        Args:
+            exclude_user_id: 除外するユーザーID（通常は現在のユーザー）
+            num_users: サンプリングするユーザー数（1〜OTHER_USERS_MAX_SAMPLEに丸める）
+        Returns:
+            {"user_id": ユーザーID, "history": 履歴のリスト} のリスト
+        """
+        if self.db is None:
+            print("Firestore is not available, returning empty history")
+            return []
+        num_users = min(max(int(num_users), 1), OTHER_USERS_MAX_SAMPLE)
+
+        def load():
+            return [
+                {"user_id": uid, "history": self._load_whisky_collection(uid)}
+                for uid in self._sample_user_ids(num_users, exclude_user_id)
+            ]
+
+        try:
+            return await firestore_executor.run(load)
+        except Exception as e:
+            print(f"Failed to get other users history: {e}")
+            return []
+
+    def _stream_all_whisky_items(self, fields: List[str]):
+        """全ユーザーのwhisky_collectionから指定したフィールドだけを読み込む内部メソッド"""
+        docs = self.db.collection_group("whisky_collection").select(fields).stream()
+        for doc in docs:
+            yield doc.reference.parent.parent.id, doc.id, doc.to_dict()
+
+    def _rebuild_indexes(self):
+        try:
+            rebuild_indexes([cooccurrence_index, note_index], self._stream_all_whisky_items)
+        except Exception as e:
+            print(f"Failed to rebuild whisky indexes: {e}")
+
+    def schedule_index_rebuild(self):
+        """共起インデックスとテイスティングノートのインデックスが未作成または期限切れの場合、
+        whisky_collection全体を1回読んでバックグラウンドでまとめて作り直す（作成中の場合は何もしない）
+
+        イベントループ上から呼び出す。サーバーの起動時にも呼び出し、最初の問い合わせまでに作成しておく。
+        """
+        if self.db is None or not (cooccurrence_index.needs_rebuild() or note_index.needs_rebuild()):
+            return
+        if self._index_task is not None and not self._index_task.done():
+            return
+        self._index_task = asyncio.ensure_future(firestore_executor.run(self._rebuild_indexes))
 
-        return random.choice(user_ids)
+    async def get_cooccurrence_recommendations(self, user_id: str, top_n: int = COOCCURRENCE_TOP_N) -> list:
+        """ユーザーの記録と一緒に他のユーザーが記録しているウイスキーを、共起の強い順に返す
+
+        共起インデックスの作成は待たない。未作成の場合は空のリストを返し（呼び出し側は他ユーザーの
+        履歴の取得にフォールバックする）、期限切れの場合は古いインデックスで答えつつバックグラウンドで作り直す。
+        """
+        if self.db is None:
+            print("Firestore is not available, returning no recommendations")
+            return []
+
+        self.schedule_index_rebuild()
+        if not cooccurrence_index.is_built:
+            print("Co-occurrence index is not ready yet, returning no recommendations")
+            return []
+
+        history = await self.get_whisky_history(user_id)
+        keys = [key for key in (item_key(doc.get("brand"), doc.get("age")) for doc in history) if key]
+        return cooccurrence_index.recommend(list(dict.fromkeys(keys)), top_n)
+
+    async def find_similar_whiskies(self, query: str, top_k: int = NOTE_INDEX_TOP_K) -> list:
+        """銘柄名または香り・味わいの特徴から、テイスティングノートが似ているウイスキーを返す
+
+        インデックスの作成は待たない。未作成の場合は空のリストを返し、期限切れの場合は古いインデックスで
+        答えつつバックグラウンドで作り直す。
+        """
+        if self.db is None:
+            print("Firestore is not available, returning no similar whiskies")
+            return []
+
+        self.schedule_index_rebuild()
+        if not note_index.is_built:
+            print("Note vector index is not ready yet, returning no similar whiskies")
+            return []
+        return note_index.search(query, top_k)
 
     async def get_whisky_history(self, user_id: str = None, exclude_user_id: str = None):
-        """ウイスキー履歴を取得（Firestoreが利用できない場合は空のリストを返す）"""
+        """ウイスキー履歴を取得（Firestoreが利用できない場合は空のリストを返す）
+
+        同期APIでの読み込みは専用スレッドで行い、その間イベントループは他のユーザーの処理を進める。
+        """
         if self.db is None:
             print("Firestore is not available, returning empty history")
             return []
 
+        try:
+            return await firestore_executor.run(self._get_whisky_history_sync, user_id, exclude_user_id)
+        except Exception as e:
+            print(f"Failed to get whisky history: {e}")
+            return []
+
+    def _get_whisky_history_sync(self, user_id: str = None, exclude_user_id: str = None) -> list:
+        """get_whisky_historyの同期処理部分"""
         try:
             if user_id:
                 # 特定ユーザーの履歴を取得
-                history = self._get_whisky_collection_for_user(user_id)
+                history = self._load_whisky_collection(user_id)
                 print(f"Retrieved {len(history)} whisky records for user {user_id}")
                 return history
             else:
@@ -98,7 +632,7 @@ class FirestoreClient:
                     random_user_id = self._get_random_user_id(exclude_user_id)
                     print(f"Selected random user_id: {random_user_id}")
 
-                    history = self._get_whisky_collection_for_user(random_user_id)
+                    history = self._load_whisky_collection(random_user_id)
                     print(f"Retrieved {len(history)} whisky records for random user {random_user_id}")
                     return history
 
@@ -111,3 +645,103 @@ class FirestoreClient:
         except Exception as e:
             print(f"Failed to get whisky history: {e}")
             return []
+
+
+class FirestoreClientPool:
+    """プロセス全体で共有するFirestoreClientを管理する
+
+    最初に必要になった時点で1度だけ作成し、以降は同じクライアント（接続）を再利用する。
+    初期化に失敗した場合は失敗状態をキャッシュし、バックオフ期間中は再試行せずに
+    Firestoreなしのクライアントを返す。
+    """
+
+    def __init__(self, backoff_seconds: float = 5.0, backoff_max_seconds: float = 300.0):
+        self.backoff_seconds = backoff_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self._client = None
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._retry_at = 0.0
+
+        # メトリクス
+        self.constructions = 0
+        self.init_failures = 0
+        self.reuses = 0
+        self.backoff_skips = 0
+
+    def _reuse(self, client):
+        """再利用できる場合はクライアントを返す（再作成が必要ならNone）"""
+        if client is None:
+            return None
+        if client.db is not None:
+            self.reuses += 1
+            return client
+        if time.monotonic() < self._retry_at:
+            self.backoff_skips += 1
+            return client
+        return None
+
+    def get(self) -> FirestoreClient:
+        client = self._reuse(self._client)
+        if client is not None:
+            return client
+
+        with self._lock:
+            # 他のスレッドが先に作成している場合はそれを使う
+            client = self._reuse(self._client)
+            if client is not None:
+                return client
+
+            client = FirestoreClient()
+            self.constructions += 1
+            if client.db is None:
+                self.init_failures += 1
+                self._consecutive_failures += 1
+                backoff = min(
+                    self.backoff_seconds * 2 ** (self._consecutive_failures - 1),
+                    self.backoff_max_seconds,
+                )
+                self._retry_at = time.monotonic() + backoff
+                print(f"Firestore initialization will be retried in {backoff:.0f} seconds")
+            else:
+                self._consecutive_failures = 0
+            self._client = client
+            return client
+
+    async def get_async(self) -> FirestoreClient:
+        """イベントループ上から呼び出す場合のget
+
+        作成や再試行（認証情報の読み込みや接続の準備）は専用スレッドで行い、イベントループをブロックしない。
+        """
+        client = self._reuse(self._client)
+        if client is not None:
+            return client
+        return await firestore_executor.run(self.get)
+
+    def stats(self) -> dict:
+        client = self._client
+        return {
+            "available": client is not None and client.db is not None,
+            "constructions": self.constructions,
+            "init_failures": self.init_failures,
+            "reuses": self.reuses,
+            "backoff_skips": self.backoff_skips,
+            "retry_in_seconds": round(max(self._retry_at - time.monotonic(), 0.0), 1)
+            if client is not None and client.db is None else 0.0,
+        }
+
+
+firestore_client_pool = FirestoreClientPool(
+    backoff_seconds=FIRESTORE_INIT_BACKOFF_SECONDS,
+    backoff_max_seconds=FIRESTORE_INIT_BACKOFF_MAX_SECONDS,
+)
+
+
+def get_firestore_client() -> FirestoreClient:
+    """プロセス全体で共有するFirestoreClientを返す（スクリプトなどイベントループの外から使う）"""
+    return firestore_client_pool.get()
+
+
+async def get_firestore_client_async() -> FirestoreClient:
+    """プロセス全体で共有するFirestoreClientを返す（ツールなどイベントループ上から使う）"""
+    return await firestore_client_pool.get_async()
@@ -0,0 +1,144 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+# ユーザーごとのウイスキー履歴キャッシュの設定
+HISTORY_CACHE_ENABLED = os.getenv("HISTORY_CACHE_ENABLED", "true").lower() == "true"
+HISTORY_CACHE_TTL_SECONDS = float(os.getenv("HISTORY_CACHE_TTL_SECONDS", 300))
+HISTORY_CACHE_MAX_USERS = int(os.getenv("HISTORY_CACHE_MAX_USERS", 1000))
+# 差分同期時にカーソルより少し前から読み直す秒数（インスタンス間の時計のずれや遅延書き込みの吸収）
+HISTORY_SYNC_OVERLAP_SECONDS = float(os.getenv("HISTORY_SYNC_OVERLAP_SECONDS", 10))
+
+
+def _latest_updated_at(docs, cursor: Optional[datetime] = None) -> Optional[datetime]:
+    """ドキュメントのupdated_atの最大値を返す"""
+    for doc in docs:
+        updated_at = doc.get("updated_at")
+        if isinstance(updated_at, datetime) and (cursor is None or updated_at > cursor):
+            cursor = updated_at
+    return cursor
+
+
+class HistoryCache:
+    """ユーザーごとのwhisky_collectionを保持するリードスルーキャッシュ
+
+    ttl秒を過ぎたエントリは、同期カーソル（読み込んだドキュメントのupdated_atの最大値）以降に
+    更新されたドキュメントだけを読み込んでmergeする。max_usersを超えた場合は最も古く使われた
+    ユーザーから破棄する。保存時はpatchでキャッシュ内のドキュメントを直接更新するため、
+    自分の保存はすぐに読み返せる（カーソルはFirestoreから読んだ値でのみ進める）。
+    保存に失敗した場合はinvalidateでユーザーのエントリを破棄し、次回はFirestoreから読み直す。
+    Firestoreの呼び出しは専用スレッドから行われるため、操作はロックで保護する。
+    """
+
+    def __init__(self, ttl: float = 300.0, max_users: int = 1000):
+        self.ttl = ttl
+        self.max_users = max_users
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+        # メトリクス
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.patches = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.full_loads = 0
+        self.incremental_syncs = 0
+        self.document_reads = 0
+
+    def get(self, user_id: str) -> Optional[List[dict]]:
+        """キャッシュ済みの履歴を返す（未取得または期限切れの場合はNone）"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            if time.monotonic() - entry["loaded_at"] > self.ttl:
+                self.expired += 1
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(user_id)
+            return [dict(doc) for doc in entry["docs"].values()]
+
+    def sync_cursor(self, user_id: str) -> Optional[datetime]:
+        """差分同期で読み込みを始める時刻を返す（キャッシュがない場合はNoneで全件読み込み）"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry["cursor"] is None:
+                return None
+            return entry["cursor"] - timedelta(seconds=HISTORY_SYNC_OVERLAP_SECONDS)
+
+    def put(self, user_id: str, history: List[dict]):
+        """Firestoreから全件読み込んだ履歴を保存する"""
+        with self._lock:
+            self.full_loads += 1
+            self.document_reads += len(history)
+            self._entries[user_id] = {
+                "loaded_at": time.monotonic(),
+                "cursor": _latest_updated_at(history),
+                "docs": {doc["id"]: dict(doc) for doc in history},
+            }
+            self._store_entry(user_id)
+
+    def merge(self, user_id: str, changed: List[dict]) -> List[dict]:
+        """差分同期で読み込んだドキュメントをキャッシュにマージし、全体の履歴を返す"""
+        with self._lock:
+            self.incremental_syncs += 1
+            self.document_reads += len(changed)
+            entry = self._entries.get(user_id)
+            if entry is None:
+                entry = {"cursor": None, "docs": {}}
+                self._entries[user_id] = entry
+            for doc in changed:
+                entry["docs"][doc["id"]] = dict(doc)
+            entry["cursor"] = _latest_updated_at(changed, entry["cursor"])
+            entry["loaded_at"] = time.monotonic()
+            self._store_entry(user_id)
+            return [dict(doc) for doc in entry["docs"].values()]
+
+    def _store_entry(self, user_id: str):
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def patch(self, user_id: str, whisky_id: str, data: dict):
+        """保存した内容をキャッシュ済みのドキュメントにマージする（未キャッシュのユーザーは何もしない）"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            doc = entry["docs"].setdefault(whisky_id, {"id": whisky_id})
+            doc.update(data)
+            self.patches += 1
+
+    def invalidate(self, user_id: str):
+        """ユーザーのキャッシュを破棄する"""
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": HISTORY_CACHE_ENABLED,
+            "users": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "patches": self.patches,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "full_loads": self.full_loads,
+            "incremental_syncs": self.incremental_syncs,
+            "document_reads": self.document_reads,
+        }
+
+
+history_cache = HistoryCache(ttl=HISTORY_CACHE_TTL_SECONDS, max_users=HISTORY_CACHE_MAX_USERS)
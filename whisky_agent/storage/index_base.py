@@ -0,0 +1,131 @@
+import os
+import threading
+from abc import ABC, abstractmethod
+import time
+from typing import Callable, Iterable, List, Tuple
+
+# 全ユーザーのwhisky_collectionからインメモリのインデックスを作り直す間隔（秒）
+WHISKY_INDEX_REBUILD_SECONDS = float(os.getenv("WHISKY_INDEX_REBUILD_SECONDS", 3600))
+
+
+class RebuildableIndex(ABC):
+    """全ユーザーのwhisky_collectionから作るインメモリインデックスの基底クラス
+
+    定期的にコレクション全体から別のインスタンスに作り直して差し替え、その間の保存はpatchで反映する。
+    作成中に届いた保存は記録しておき、差し替える前に新しいインデックスにも反映するため失われない。
+    サブクラスはSCAN_FIELDSと_new_empty・_apply・_swap_fromを実装する。
+    """
+
+    # 作成時にwhisky_collectionから読み込むフィールド
+    SCAN_FIELDS: Tuple[str, ...] = ()
+
+    def __init__(self, rebuild_interval: float = 3600.0):
+        self.rebuild_interval = rebuild_interval
+        self._lock = threading.Lock()
+        self._built_at = None
+        self._rebuilding = False
+        self._pending_patches = []
+
+        # メトリクス
+        self.rebuilds = 0
+        self.last_rebuild_seconds = 0.0
+        self.patches = 0
+        self.replayed_patches = 0
+
+    @property
+    def is_built(self) -> bool:
+        return self._built_at is not None
+
+    def needs_rebuild(self) -> bool:
+        return self._built_at is None or time.monotonic() - self._built_at > self.rebuild_interval
+
+    @abstractmethod
+    def _new_empty(self) -> "RebuildableIndex":
+        """作り直し用の空のインスタンスを返す"""
+
+    @abstractmethod
+    def _apply(self, user_id: str, whisky_id: str, data: dict) -> bool:
+        """1件のドキュメント（または保存された差分）を反映する（変化がなければFalse）"""
+
+    @abstractmethod
+    def _swap_from(self, fresh: "RebuildableIndex"):
+        """作り直したインスタンスの内容に差し替える（ロックを取得した状態で呼ばれる）"""
+
+    def begin_rebuild(self):
+        """作り直しを始め、ドキュメントを反映していく空のインスタンスを返す（作成中の場合はNone）"""
+        with self._lock:
+            if self._rebuilding:
+                return None
+            self._rebuilding = True
+            self._pending_patches = []
+        return self._new_empty()
+
+    def finish_rebuild(self, fresh: "RebuildableIndex", started_at: float):
+        """作成中に届いた保存を反映してから、作り直したインスタンスに差し替える"""
+        with self._lock:
+            for user_id, whisky_id, data in self._pending_patches:
+                fresh._apply(user_id, whisky_id, data)
+            self.replayed_patches += len(self._pending_patches)
+            self._swap_from(fresh)
+            self._built_at = time.monotonic()
+            self._rebuilding = False
+            self._pending_patches = []
+        self.rebuilds += 1
+        self.last_rebuild_seconds = self._built_at - started_at
+
+    def abort_rebuild(self):
+        with self._lock:
+            self._rebuilding = False
+            self._pending_patches = []
+
+    def patch(self, user_id: str, whisky_id: str, data: dict):
+        """保存された内容を反映する（作成中の場合は作り直したインスタンスにも後で反映する）"""
+        with self._lock:
+            if self._rebuilding:
+                self._pending_patches.append((user_id, whisky_id, dict(data)))
+            if self.is_built and self._apply(user_id, whisky_id, data):
+                self.patches += 1
+
+    def _base_stats(self) -> dict:
+        return {
+            "built": self.is_built,
+            "rebuilding": self._rebuilding,
+            "rebuilds": self.rebuilds,
+            "last_rebuild_seconds": round(self.last_rebuild_seconds, 3),
+            "patches": self.patches,
+            "replayed_patches": self.replayed_patches,
+        }
+
+
+def rebuild_indexes(indexes: List[RebuildableIndex], stream: Callable[[List[str]], Iterable[Tuple[str, str, dict]]]):
+    """複数のインデックスを、whisky_collection全体を1回読むだけでまとめて作り直す
+
+    Args:
+        indexes: 作り直すインデックス（作成中のものは除く）
+        stream: 読み込むフィールドを受け取り、(user_id, whisky_id, ドキュメント) を返す関数
+    """
+    started_at = time.monotonic()
+    builds = []
+    for index in indexes:
+        fresh = index.begin_rebuild()
+        if fresh is not None:
+            builds.append((index, fresh))
+    if not builds:
+        return
+
+    fields = list(dict.fromkeys(field for index, _ in builds for field in index.SCAN_FIELDS))
+    try:
+        documents = 0
+        for user_id, whisky_id, doc in stream(fields):
+            documents += 1
+            for _, fresh in builds:
+                fresh._apply(user_id, whisky_id, doc)
+    except Exception:
+        for index, _ in builds:
+            index.abort_rebuild()
+        raise
+
+    for index, fresh in builds:
+        index.finish_rebuild(fresh, started_at)
+    names = ", ".join(type(index).__name__ for index, _ in builds)
+    print(f"Rebuilt {names} from {documents} documents in {time.monotonic() - started_at:.2f} s")
@@ -0,0 +1,243 @@
+import hashlib
+import os
+import re
+import time
+import unicodedata
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from .cooccurrence import item_key, item_label
+from .index_base import WHISKY_INDEX_REBUILD_SECONDS, RebuildableIndex
+
+# テイスティングノートのベクトルの次元数（特徴をハッシュで割り当てるバケット数）
+NOTE_INDEX_DIM = int(os.getenv("NOTE_INDEX_DIM", 256))
+# テイスティングノートの類似検索で返す件数
+NOTE_INDEX_TOP_K = int(os.getenv("NOTE_INDEX_TOP_K", 5))
+
+NOTE_FIELDS = ("nose", "palate", "finish")
+# 特徴全体に対する、同じ項目（香り・味わい・余韻）で一致した場合と部分一致（文字のbigram）の重み
+FIELD_WEIGHT = 0.5
+BIGRAM_WEIGHT = 0.3
+# 検索結果に含める共通の特徴と、候補の特徴の数
+SHARED_NOTES_TOP_N = 5
+CANDIDATE_NOTES_TOP_N = 6
+# これより類似度が低いノートは、ハッシュの衝突による偶然の一致とみなして返さない
+MIN_SIMILARITY = 0.1
+
+_DESCRIPTOR_SEPARATORS = re.compile(r"[、,，/／・\s]+")
+# 銘柄名の後ろに続く熟成年数の表記（例: "山崎12年" の "12年"）
+_AGE_SUFFIX = re.compile(r"(\d+(年|y|yo|years?(old)?)?)?$")
+
+
+def normalize_descriptor(descriptor) -> str:
+    """表記ゆれを吸収した特徴の文字列（例: "バニラ"）を返す"""
+    return "".join(unicodedata.normalize("NFKC", str(descriptor or "")).lower().split())
+
+
+@lru_cache(maxsize=65536)
+def _hash_feature(feature: str, dim: int) -> Tuple[int, float]:
+    """特徴をバケットと符号に割り当てる（プロセスをまたいで同じ値になるようblake2bを使う）"""
+    value = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), "little")
+    return value % dim, 1.0 if value >> 63 else -1.0
+
+
+def _features(descriptor: str, field: Optional[str] = None) -> List[Tuple[str, float]]:
+    features = [(descriptor, 1.0)]
+    if field:
+        features.append((f"{field}:{descriptor}", FIELD_WEIGHT))
+    if len(descriptor) > 2:
+        features.extend((f"#{descriptor[i:i + 2]}", BIGRAM_WEIGHT) for i in range(len(descriptor) - 1))
+    return features
+
+
+def vectorize(notes: dict, dim: int = 256) -> np.ndarray:
+    """{項目: 特徴のリスト} をL2正規化したハッシュ済みbag-of-descriptorsのベクトルに変換する"""
+    vector = np.zeros(dim, dtype=np.float32)
+    for field, descriptors in notes.items():
+        for descriptor in descriptors:
+            for feature, weight in _features(descriptor, field):
+                bucket, sign = _hash_feature(feature, dim)
+                vector[bucket] += sign * weight
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def extract_notes(doc: dict) -> dict:
+    """ドキュメントに含まれる香り・味わい・余韻の特徴を正規化して取り出す（空のリストもそのまま返す）"""
+    notes = {}
+    for field in NOTE_FIELDS:
+        values = doc.get(field)
+        if not isinstance(values, list):
+            continue
+        descriptors = list(dict.fromkeys(normalize_descriptor(value) for value in values if isinstance(value, str)))
+        notes[field] = [descriptor for descriptor in descriptors if descriptor]
+    return notes
+
+
+class NoteVectorIndex(RebuildableIndex):
+    """全ユーザーのテイスティングノートのベクトルを保持し、似た味わいのウイスキーを検索する
+
+    1件のノートを1列としてNumPyの行列（次元数×ノート数）に持ち、検索は行列とクエリのベクトルの内積
+    （コサイン類似度）で行う。クエリのベクトルは0でない次元が少ないため、その次元の行だけを読んで計算する。
+    """
+
+    SCAN_FIELDS = ("brand", "age", *NOTE_FIELDS)
+
+    def __init__(self, dim: int = 256, rebuild_interval: float = 3600.0, initial_capacity: int = 1024):
+        super().__init__(rebuild_interval)
+        self.dim = dim
+        self.initial_capacity = initial_capacity
+        self._reset()
+
+        # メトリクス
+        self.queries = 0
+        self.last_query_ms = 0.0
+
+    def _reset(self):
+        self._matrix = np.zeros((self.dim, self.initial_capacity), dtype=np.float32)
+        self._size = 0  # 使用済みの列数
+        self._columns = {}  # (user_id, whisky_id) -> 列番号
+        self._meta = {}  # 列番号 -> {"key", "label", "brand", "age", "notes"}
+        self._brands = {}  # 正規化した銘柄名 -> 列番号の集合（銘柄名での検索用）
+
+    def _new_empty(self) -> "NoteVectorIndex":
+        return NoteVectorIndex(self.dim, self.rebuild_interval, self.initial_capacity)
+
+    def _swap_from(self, fresh: "NoteVectorIndex"):
+        self._matrix, self._size = fresh._matrix, fresh._size
+        self._columns, self._meta, self._brands = fresh._columns, fresh._meta, fresh._brands
+
+    def _allocate_column(self) -> int:
+        if self._size == self._matrix.shape[1]:
+            matrix = np.zeros((self.dim, self._matrix.shape[1] * 2), dtype=np.float32)
+            matrix[:, : self._size] = self._matrix
+            self._matrix = matrix
+        self._size += 1
+        return self._size - 1
+
+    def _remove_column(self, user_id: str, whisky_id: str, column: int):
+        """ノートを取り除く（列は再利用せず0にしておく）"""
+        meta = self._meta.pop(column)
+        self._brands[meta["key"].split("|")[0]].discard(column)
+        del self._columns[(user_id, whisky_id)]
+        self._matrix[:, column] = 0.0
+
+    def _apply(self, user_id: str, whisky_id: str, doc: dict) -> bool:
+        """1件のノートを追加・更新する（特徴や銘柄が消された場合は取り除く）"""
+        column = self._columns.get((user_id, whisky_id))
+        meta = self._meta.get(column, {}) if column is not None else {}
+        notes = {**meta.get("notes", {}), **extract_notes(doc)}
+        notes = {field: descriptors for field, descriptors in notes.items() if descriptors}
+        brand = doc.get("brand") if "brand" in doc else meta.get("brand")
+        age = doc.get("age") if "age" in doc else meta.get("age")
+        key = item_key(brand, age)
+
+        if not notes or key is None:
+            if column is None:
+                return False
+            self._remove_column(user_id, whisky_id, column)
+            return True
+        if column is None:
+            column = self._allocate_column()
+            self._columns[(user_id, whisky_id)] = column
+        elif notes == meta["notes"] and key == meta["key"]:
+            return False
+
+        if meta:
+            self._brands[meta["key"].split("|")[0]].discard(column)
+        self._brands.setdefault(key.split("|")[0], set()).add(column)
+        self._matrix[:, column] = vectorize(notes, self.dim)
+        self._meta[column] = {"key": key, "label": item_label(brand, age), "brand": brand, "age": age, "notes": notes}
+        return True
+
+    def _match_brand(self, query: str) -> Optional[str]:
+        """クエリ全体、または区切られた語のいずれかが「銘柄名（+熟成年数）」と一致する場合にその銘柄名を返す
+
+        部分文字列では照合しないため、「響」のような短い銘柄名が特徴の語（例: "響きのある甘さ"）に一致しない。
+        """
+        text = unicodedata.normalize("NFKC", str(query or "")).lower()
+        candidates = ["".join(text.split()), *_DESCRIPTOR_SEPARATORS.split(text)]
+        for candidate in candidates:
+            for brand in (candidate, _AGE_SUFFIX.sub("", candidate, count=1)):
+                if brand and self._brands.get(brand):
+                    return brand
+        return None
+
+    def _query_notes(self, query: str) -> Tuple[dict, set]:
+        """クエリを特徴に変換する
+
+        記録済みの銘柄名と一致する場合はその銘柄のノートの特徴を、それ以外は読点などで区切った特徴を使う。
+        Returns:
+            ({項目: 特徴のリスト}, 検索結果から除くアイテムのキー)
+        """
+        matched_brand = self._match_brand(query)
+        if matched_brand:
+            notes, keys = {}, set()
+            for column in self._brands[matched_brand]:
+                meta = self._meta[column]
+                keys.add(meta["key"])
+                for field, descriptors in meta["notes"].items():
+                    notes.setdefault(field, []).extend(descriptors)
+            return notes, keys
+
+        descriptors = [normalize_descriptor(part) for part in _DESCRIPTOR_SEPARATORS.split(str(query or ""))]
+        return {None: [descriptor for descriptor in descriptors if descriptor]}, set()
+
+    def search(self, query: str, top_k: int = 5) -> List[dict]:
+        """銘柄名または特徴に似た味わいのウイスキーを、類似度の高い順にtop_k銘柄返す"""
+        started_at = time.perf_counter()
+        with self._lock:
+            self.queries += 1
+            notes, exclude = self._query_notes(query)
+            vector = vectorize(notes, self.dim)
+            if not self._size or not vector.any():
+                return []
+
+            dims = np.flatnonzero(vector)
+            if len(dims) * 2 < self.dim:
+                scores = vector[dims] @ self._matrix[dims, : self._size]
+            else:
+                scores = vector @ self._matrix[:, : self._size]
+            # 同じ銘柄のノートが複数並ぶことがあるため、多めに候補を取ってから銘柄単位にまとめる
+            candidates = min(self._size, max(top_k * 10, 50))
+            top_columns = np.argpartition(-scores, candidates - 1)[:candidates]
+            top_columns = top_columns[np.argsort(-scores[top_columns])]
+
+            query_descriptors = {descriptor for descriptors in notes.values() for descriptor in descriptors}
+            results, seen = [], set(exclude)
+            for column in top_columns:
+                meta = self._meta.get(int(column))
+                if meta is None or scores[column] < MIN_SIMILARITY or meta["key"] in seen:
+                    continue
+                seen.add(meta["key"])
+                # 複数の項目に同じ特徴がある場合は1回だけ返す
+                descriptors = list(
+                    dict.fromkeys(descriptor for field in NOTE_FIELDS for descriptor in meta["notes"].get(field, []))
+                )
+                results.append(
+                    {
+                        "whisky": meta["label"],
+                        "similarity": round(float(scores[column]), 3),
+                        "shared_notes": [d for d in descriptors if d in query_descriptors][:SHARED_NOTES_TOP_N],
+                        "notes": descriptors[:CANDIDATE_NOTES_TOP_N],
+                    }
+                )
+                if len(results) >= top_k:
+                    break
+            self.last_query_ms = (time.perf_counter() - started_at) * 1000
+            return results
+
+    def stats(self) -> dict:
+        return {
+            **self._base_stats(),
+            "notes": len(self._columns),
+            "dim": self.dim,
+            "capacity": self._matrix.shape[1],
+            "queries": self.queries,
+            "last_query_ms": round(self.last_query_ms, 2),
+        }
+
+
+note_index = NoteVectorIndex(dim=NOTE_INDEX_DIM, rebuild_interval=WHISKY_INDEX_REBUILD_SECONDS)
@@ -0,0 +1,144 @@
+import os
+import threading
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from .aggregates import UNKNOWN_CATEGORY, parse_rating
+
+# 時系列の集計をキャッシュするユーザー数の上限
+TREND_CACHE_MAX_USERS = int(os.getenv("TREND_CACHE_MAX_USERS", 1000))
+
+JST = timezone(timedelta(hours=9))
+
+
+def month_key(timestamp) -> Optional[str]:
+    """日時を日本時間の年月（例: "2025-06"）に変換する"""
+    if not isinstance(timestamp, datetime):
+        return None
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(JST)
+    return timestamp.strftime("%Y-%m")
+
+
+def recorded_month(doc: dict) -> Optional[str]:
+    """ドキュメントを集計する年月を返す
+
+    初回保存時に書き込むcreated_atを使い、ない場合（created_atを書き込む前に保存された記録など）は
+    updated_atを使う。後者は編集やテイスティングノートの保存で最新の月に移る。
+    """
+    return month_key(doc.get("created_at")) or month_key(doc.get("updated_at"))
+
+
+def _new_bucket() -> dict:
+    return {"count": 0, "rating_sum": 0.0, "rating_count": 0, "region": Counter(), "whisky_type": Counter()}
+
+
+class TrendCache:
+    """ユーザーごとの月別集計を保持し、ドキュメント単位で増分更新する
+
+    各ドキュメントがどの月（記録した月）にどれだけ寄与しているかを覚えておき、保存で評価などが
+    変わった場合は古い寄与を引いて新しい寄与を足す。四半期などの粒度は月別集計から作る。
+    """
+
+    def __init__(self, max_users: int = 1000):
+        self.max_users = max_users
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+        # メトリクス
+        self.builds = 0
+        self.synced_docs = 0
+        self.applied_saves = 0
+
+    @staticmethod
+    def _contribution(doc: dict, month: Optional[str] = None) -> Optional[tuple]:
+        month = month or recorded_month(doc)
+        if month is None:
+            return None
+        return (
+            month,
+            parse_rating(doc.get("rating")),
+            doc.get("region") or UNKNOWN_CATEGORY,
+            doc.get("whisky_type") or UNKNOWN_CATEGORY,
+        )
+
+    @staticmethod
+    def _add(buckets: dict, contribution: tuple, sign: int):
+        month, rating, region, whisky_type = contribution
+        bucket = buckets.setdefault(month, _new_bucket())
+        bucket["count"] += sign
+        if rating is not None:
+            bucket["rating_sum"] += sign * rating
+            bucket["rating_count"] += sign
+        for field, name in (("region", region), ("whisky_type", whisky_type)):
+            bucket[field][name] += sign
+            if bucket[field][name] <= 0:
+                del bucket[field][name]
+        if bucket["count"] <= 0:
+            del buckets[month]
+
+    def _update_doc(self, entry: dict, whisky_id: str, doc: dict, month: Optional[str] = None) -> bool:
+        """1件のドキュメントの寄与を差し替える（変化がなければFalse）"""
+        new = self._contribution(doc, month)
+        old = entry["docs"].get(whisky_id)
+        if old == new:
+            return False
+        if old is not None:
+            self._add(entry["buckets"], old, -1)
+        if new is not None:
+            self._add(entry["buckets"], new, 1)
+            entry["docs"][whisky_id] = new
+        else:
+            entry["docs"].pop(whisky_id, None)
+        return True
+
+    def sync(self, user_id: str, history: List[dict]) -> dict:
+        """履歴と突き合わせ、変化したドキュメントだけを反映して月別集計を返す"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                entry = {"docs": {}, "buckets": {}}
+                self._entries[user_id] = entry
+                self.builds += 1
+            for doc in history:
+                if self._update_doc(entry, doc["id"], doc):
+                    self.synced_docs += 1
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+            return self._copy_buckets(entry)
+
+    def apply(self, user_id: str, whisky_id: str, data: dict):
+        """保存された内容を反映する（未集計のユーザーは何もしない）"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            old = entry["docs"].get(whisky_id)
+            doc, month = {}, None
+            if old is not None:
+                # 既に集計済みのドキュメントは、記録した月のまま評価などだけを差し替える
+                month, rating, region, whisky_type = old
+                doc = {"rating": rating, "region": region, "whisky_type": whisky_type}
+            doc.update(data)
+            if self._update_doc(entry, whisky_id, doc, month):
+                self.applied_saves += 1
+
+    @staticmethod
+    def _copy_buckets(entry: dict) -> dict:
+        return {
+            month: {**bucket, "region": Counter(bucket["region"]), "whisky_type": Counter(bucket["whisky_type"])}
+            for month, bucket in entry["buckets"].items()
+        }
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._entries),
+            "builds": self.builds,
+            "synced_docs": self.synced_docs,
+            "applied_saves": self.applied_saves,
+        }
+
+
+trend_cache = TrendCache(max_users=TREND_CACHE_MAX_USERS)
@@ -0,0 +1,242 @@
+import os
+import queue
+import threading
+import time
+
+from .aggregates import USER_AGGREGATES_ENABLED
+
+# Firestoreへの書き込みをキューに積んでまとめてコミットするか
+FIRESTORE_WRITE_BEHIND = os.getenv("FIRESTORE_WRITE_BEHIND", "false").lower() == "true"
+# キューに積んでからコミットするまでの最大待ち時間と、1回のバッチに含める最大件数（Firestoreの上限は500）
+FIRESTORE_FLUSH_INTERVAL_MS = int(os.getenv("FIRESTORE_FLUSH_INTERVAL_MS", 200))
+FIRESTORE_BATCH_MAX_WRITES = min(int(os.getenv("FIRESTORE_BATCH_MAX_WRITES", 500)), 500)
+FIRESTORE_WRITE_BEHIND_MAX_PENDING = int(os.getenv("FIRESTORE_WRITE_BEHIND_MAX_PENDING", 10000))
+# コミットに失敗した書き込みを破棄するまでの試行回数（待ち時間は試行ごとに倍増）
+FIRESTORE_WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv("FIRESTORE_WRITE_BEHIND_MAX_ATTEMPTS", 5))
+
+_STOP = object()
+
+
+def write_behind_enabled(write_behind: bool, aggregates_enabled: bool) -> bool:
+    """保存に書き込みキューを使うか
+
+    集計ドキュメントの更新は前の値をトランザクションで読む必要があり、WriteBatchにまとめられない。
+    集計が有効な場合にキューを使っても1件ずつのトランザクションになり、バッチの効果がないまま
+    保存が失われうる期間だけが生じるため、直接書き込む。
+    """
+    return write_behind and not aggregates_enabled
+
+
+WRITE_BEHIND_ENABLED = write_behind_enabled(FIRESTORE_WRITE_BEHIND, USER_AGGREGATES_ENABLED)
+if FIRESTORE_WRITE_BEHIND and not WRITE_BEHIND_ENABLED:
+    print("FIRESTORE_WRITE_BEHIND is ignored while USER_AGGREGATES_ENABLED is true")
+
+
+class WriteBehindQueue:
+    """Firestoreへのmerge書き込みをまとめてバッチコミットする
+
+    書き込みはメモリ上のキューに積んだ時点で呼び出し元に戻り、バックグラウンドスレッドが
+    flush_interval以内（またはmax_batch件たまった時点）にWriteBatchで一括コミットする。
+    同じドキュメントへの書き込みはバッチ内で1件にまとめる。
+
+    キューは永続化しないプロセス内のメモリにあるため、積んだ書き込みは保存済みではない。
+    コミット前にプロセスが異常終了した場合や、stop()が間に合わずに停止した場合（スケールダウンなど）、
+    max_attempts回続けてコミットに失敗した場合は失われる（失われた件数はstats()のfailed・lost_on_stopで確認できる）。
+    """
+
+    def __init__(self, flush_interval: float = 0.2, max_batch: int = 500, max_pending: int = 10000, max_attempts: int = 5):
+        """
+        Args:
+            flush_interval: 最初の書き込みを受け付けてからコミットするまでの最大待ち時間（秒）
+            max_batch: 1回のバッチコミットに含める最大ドキュメント数
+            max_pending: キューに積める書き込みの上限（超えた場合enqueueはFalseを返す）
+            max_attempts: コミットに失敗した書き込みを破棄するまでの試行回数
+        """
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_attempts = max(1, max_attempts)
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = None
+        self._lock = threading.Lock()
+
+        # メトリクス
+        self.enqueued = 0
+        self.rejected = 0
+        self.written = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.failed = 0
+        self.retries = 0
+        self.lost_on_stop = 0
+        self.max_delay = 0.0
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="firestore-write-behind", daemon=True)
+                self._thread.start()
+
+    def enqueue(self, db, doc_ref, data: dict, writer=None, on_commit=None, on_failure=None) -> bool:
+        """merge書き込みをキューに積む
+
+        Args:
+            db: firestore.Client
+            doc_ref: 書き込み先のDocumentReference
+            data: mergeするデータ
+            writer: 指定した場合はバッチに含めず、まとめたデータを渡して個別に呼び出す
+                （トランザクションで書き込む必要があるドキュメント用）
+            on_commit: コミットに成功した後にバックグラウンドスレッドで呼び出す関数（破棄された場合は呼ばない）
+            on_failure: 再試行しても失敗して破棄した後にバックグラウンドスレッドで呼び出す関数
+        Returns:
+            受け付けた場合はTrue、キューが満杯の場合はFalse（呼び出し元で直接書き込む）
+        """
+        self._ensure_started()
+        callbacks = [(on_commit, on_failure)]
+        try:
+            self._queue.put_nowait((db, doc_ref, dict(data), writer, time.monotonic(), callbacks))
+        except queue.Full:
+            self.rejected += 1
+            return False
+        self.enqueued += 1
+        return True
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+
+            # 最初の1件からflush_intervalの間に届いた書き込みを同じバッチにまとめる
+            pending = {}
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                self._add(pending, item)
+                if len(pending) >= self.max_batch:
+                    break
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+            self._commit(pending)
+
+    def _add(self, pending: dict, item):
+        db, doc_ref, data, writer, queued_at, callbacks = item
+        key = doc_ref.path
+        if key in pending:
+            # 同じドキュメントへの書き込みは後の値で上書きしてまとめる（コミット後の呼び出しは積んだ順に行う）
+            _, _, merged, _, first_queued_at, merged_callbacks = pending[key]
+            merged.update(data)
+            pending[key] = (db, doc_ref, merged, writer, first_queued_at, merged_callbacks + callbacks)
+            self.coalesced += 1
+        else:
+            pending[key] = (db, doc_ref, data, writer, queued_at, callbacks)
+
+    def _commit(self, pending: dict):
+        if not pending:
+            return
+        writes = [write for write in pending.values() if write[3] is None]
+        individual_writes = [write for write in pending.values() if write[3] is not None]
+
+        if writes:
+            committed = self._retry(lambda: self._commit_batch(writes), f"batch of {len(writes)} writes", len(writes))
+            if committed:
+                self.batches += 1
+                self._record(writes)
+            else:
+                self._notify(writes, committed=False)
+        for write in individual_writes:
+            _, doc_ref, data, writer, _, _ = write
+            if self._retry(lambda: writer(data), f"write to {doc_ref.path}", 1):
+                self._record([write])
+            else:
+                self._notify([write], committed=False)
+
+    def _commit_batch(self, writes: list):
+        batch = writes[0][0].batch()
+        for _, doc_ref, data, _, _, _ in writes:
+            batch.set(doc_ref, data, merge=True)
+        batch.commit()
+
+    def _retry(self, commit, description: str, count: int) -> bool:
+        """失敗した場合は待ち時間を倍増させながらmax_attempts回まで試行する
+
+        同じドキュメントへの後の書き込みより先にコミットされるよう、再試行の間は次のバッチに進まない
+        （その間に満杯になったキューへのenqueueはFalseを返し、呼び出し元が直接書き込む）。
+        """
+        delay = self.flush_interval
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                commit()
+                return True
+            except Exception as e:
+                if attempt < self.max_attempts:
+                    print(f"Write-behind {description} failed (attempt {attempt}/{self.max_attempts}), retrying: {e}")
+                    self.retries += 1
+                    time.sleep(delay)
+                    delay *= 2
+                    continue
+                print(f"Write-behind {description} failed {attempt} times, dropped: {e}")
+                self.failed += count
+        return False
+
+    def _record(self, writes: list):
+        now = time.monotonic()
+        self.written += len(writes)
+        self.max_delay = max(self.max_delay, max(now - write[4] for write in writes))
+        self._notify(writes, committed=True)
+
+    def _notify(self, writes: list, committed: bool):
+        """書き込みごとに、積んだ順にon_commitまたはon_failureを呼び出す"""
+        for write in writes:
+            for on_commit, on_failure in write[5]:
+                callback = on_commit if committed else on_failure
+                if callback is None:
+                    continue
+                try:
+                    callback()
+                except Exception as e:
+                    print(f"Write-behind callback for {write[1].path} failed: {e}")
+
+    def stop(self, timeout: float = 10.0):
+        """キューに残った書き込みをコミットしてからスレッドを止める（timeout内に終わらなかった分は失われる）"""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            self.lost_on_stop = self._queue.qsize()
+            print(f"Write-behind queue did not drain in {timeout} s, about {self.lost_on_stop} writes lost")
+        self._thread = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": WRITE_BEHIND_ENABLED,
+            "pending": self._queue.qsize(),
+            "enqueued": self.enqueued,
+            "rejected": self.rejected,
+            "written": self.written,
+            "coalesced": self.coalesced,
+            "batches": self.batches,
+            "avg_batch_size": round(self.written / self.batches, 2) if self.batches else 0.0,
+            "retries": self.retries,
+            "failed": self.failed,
+            "lost_on_stop": self.lost_on_stop,
+            "max_delay_ms": round(self.max_delay * 1000, 1),
+        }
+
+
+write_behind_queue = WriteBehindQueue(
+    flush_interval=FIRESTORE_FLUSH_INTERVAL_MS / 1000,
+    max_batch=FIRESTORE_BATCH_MAX_WRITES,
+    max_pending=FIRESTORE_WRITE_BEHIND_MAX_PENDING,
+    max_attempts=FIRESTORE_WRITE_BEHIND_MAX_ATTEMPTS,
+)
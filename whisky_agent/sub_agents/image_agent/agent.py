@@ -2,11 +2,12 @@ from google.adk.agents import Agent
 from google.adk.tools.agent_tool import AgentTool
 from .sub_agents.image_modifier import image_modifier
 from .sub_agents.whisky_label_processor import whisky_label_processor
-from whisky_agent.storage.firestore import FirestoreClient
+from whisky_agent.storage.firestore import get_firestore_client_async
 from google.adk.tools.tool_context import ToolContext
 from .prompts import IMAGE_AGENT_INSTRUCTION
+from whisky_agent.router import update_conversation_phase
 
-def save_whisky_info(tool_context: ToolContext) -> dict:
+async def save_whisky_info(tool_context: ToolContext) -> dict:
     """ウイスキー情報をFirestoreに保存する
 
     Args:
@@ -23,8 +24,8 @@ def save_whisky_info(tool_context: ToolContext) -> dict:
     whisky_info = tool_context.state.get("whisky_info", {})
 
     # Firestoreクライアントを使用してテイスティングノートを保存
-    firestore_client = FirestoreClient()
-    firestore_client.save_whisky_info(user_id, whisky_id, whisky_info)
+    firestore_client = await get_firestore_client_async()
+    await firestore_client.save_whisky_info_async(user_id, whisky_id, whisky_info)
 
     return {
         "action": "save_whisky_info_to_firestore",
@@ -41,5 +42,6 @@ image_agent = Agent(
     tools=[
         AgentTool(image_modifier),
         save_whisky_info,
-        ]
+        ],
+    before_agent_callback=update_conversation_phase,
 )
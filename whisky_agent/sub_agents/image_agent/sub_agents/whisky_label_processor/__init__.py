@@ -1,11 +1,21 @@
 from .agent import (
+    adaptive_label_extracter,
+    adaptive_resolution_stats,
     image_extracter,
+    image_extracter_full,
+    label_summary_renderer,
     output_reviser,
+    render_label_summary,
     whisky_label_processor,
 )
 
 __all__ = [
+    'adaptive_label_extracter',
+    'adaptive_resolution_stats',
     'image_extracter',
+    'image_extracter_full',
+    'label_summary_renderer',
     'output_reviser',
+    'render_label_summary',
     'whisky_label_processor',
 ]
@@ -1,7 +1,202 @@
-from google.adk.agents import Agent, SequentialAgent
-from .prompts import IMAGE_EXTRACTER_INSTRUCTION
+import asyncio
+import os
+import time
+from typing import AsyncGenerator, Optional
+from google.adk.agents import Agent, BaseAgent, SequentialAgent
+from google.adk.agents.callback_context import CallbackContext
+from google.adk.agents.invocation_context import InvocationContext
+from google.adk.events import Event
+from google.adk.models import LlmRequest, LlmResponse
+from google.genai import types
+from .prompts import IMAGE_EXTRACTER_INSTRUCTION, LABEL_SUMMARY_TEMPLATE
 from .....models import WhiskyInfo
 from .....models import create_whisky_id
+from .....image_processing import preprocess_image
+from .....label_cache import LABEL_CACHE_ENABLED, label_cache, label_hashes
+
+# 低解像度で先に抽出し、主要項目が空の場合のみ元の解像度で再抽出する
+LABEL_ADAPTIVE_RESOLUTION = os.getenv("LABEL_ADAPTIVE_RESOLUTION", "true").lower() == "true"
+LABEL_THUMBNAIL_MAX_EDGE = int(os.getenv("LABEL_THUMBNAIL_MAX_EDGE", 512))
+
+# 抽出結果の返答を "template"（Pythonで整形）と "llm"（output_reviser）のどちらで作るか
+LABEL_SUMMARY_MODE = os.getenv("LABEL_SUMMARY_MODE", "template").lower()
+LABEL_SUMMARY_EMPTY_VALUE = os.getenv("LABEL_SUMMARY_EMPTY_VALUE", "不明")
+
+# これらが空の場合は読み取り失敗とみなして再抽出する
+KEY_FIELDS = ("brand", "age", "distillery")
+
+
+class AdaptiveResolutionStats:
+    """低解像度抽出の効果を集計する"""
+
+    def __init__(self):
+        self.runs = 0
+        self.escalations = 0
+        self.full_bytes = 0
+        self.sent_bytes = 0
+        self.thumbnail_seconds = 0.0
+        self.full_seconds = 0.0
+
+    def stats(self) -> dict:
+        # 常に元の解像度で送った場合との差分（再抽出時は低解像度の分だけ余計にかかる）
+        avg_full_seconds = self.full_seconds / self.escalations if self.escalations else None
+        saved_seconds = None
+        if avg_full_seconds is not None and self.runs:
+            saved_seconds = (avg_full_seconds * self.runs - self.thumbnail_seconds - self.full_seconds) / self.runs
+        return {
+            "runs": self.runs,
+            "escalations": self.escalations,
+            "escalation_rate": round(self.escalations / self.runs, 4) if self.runs else 0.0,
+            "avg_bytes_saved": round((self.full_bytes - self.sent_bytes) / self.runs) if self.runs else 0,
+            "avg_latency_saved_ms": round(saved_seconds * 1000, 1) if saved_seconds is not None else None,
+        }
+
+
+adaptive_resolution_stats = AdaptiveResolutionStats()
+
+
+async def use_thumbnail_image(callback_context: CallbackContext, llm_request: LlmRequest) -> Optional[LlmResponse]:
+    """リクエスト内の画像を縮小版に差し替える"""
+    for content in llm_request.contents:
+        for index, part in enumerate(content.parts or []):
+            if not (part.inline_data and part.inline_data.data):
+                continue
+            try:
+                thumbnail, mime_type = await asyncio.to_thread(
+                    preprocess_image, part.inline_data.data, LABEL_THUMBNAIL_MAX_EDGE
+                )
+            except Exception as e:
+                print(f"Thumbnail creation skipped: {e}")
+                continue
+            adaptive_resolution_stats.full_bytes += len(part.inline_data.data)
+            adaptive_resolution_stats.sent_bytes += len(thumbnail)
+            content.parts[index] = types.Part(
+                inline_data=types.Blob(mime_type=mime_type, data=thumbnail)
+            )
+    return None
+
+
+def count_full_image_bytes(callback_context: CallbackContext, llm_request: LlmRequest) -> Optional[LlmResponse]:
+    """再抽出で送る元画像のサイズを記録する"""
+    for content in llm_request.contents:
+        for part in content.parts or []:
+            if part.inline_data and part.inline_data.data:
+                adaptive_resolution_stats.sent_bytes += len(part.inline_data.data)
+    return None
+
+
+def find_image_data(content: Optional[types.Content]) -> Optional[bytes]:
+    """ユーザーのメッセージから画像データを取り出す"""
+    if not content or not content.parts:
+        return None
+    for part in content.parts:
+        if part.inline_data and part.inline_data.data:
+            return part.inline_data.data
+    return None
+
+
+class AdaptiveLabelExtracter(BaseAgent):
+    """低解像度で抽出し、主要項目が読み取れなかった場合のみ元の解像度で再抽出するエージェント
+
+    ほぼ同一のラベル画像を過去に抽出済みの場合は、キャッシュした結果を使ってLLM呼び出しを省略する。
+    """
+
+    thumbnail_extracter: Agent
+    full_extracter: Agent
+
+    def __init__(self, name: str, thumbnail_extracter: Agent, full_extracter: Agent, **kwargs):
+        super().__init__(
+            name=name,
+            thumbnail_extracter=thumbnail_extracter,
+            full_extracter=full_extracter,
+            sub_agents=[thumbnail_extracter, full_extracter],
+            **kwargs,
+        )
+
+    async def _run_async_impl(self, ctx: InvocationContext) -> AsyncGenerator[Event, None]:
+        image_hashes = None
+        image_data = find_image_data(ctx.user_content)
+        if LABEL_CACHE_ENABLED and image_data:
+            try:
+                image_hashes = await asyncio.to_thread(label_hashes, image_data)
+            except Exception as e:
+                print(f"Perceptual hash skipped: {e}")
+
+        if image_hashes is not None:
+            cached = label_cache.get(*image_hashes)
+            if cached:
+                print(f"--- Label cache hit: {cached.get('brand', '')} ---")
+                # image_extracterと同じくwhisky_idを用意してから、キャッシュした情報をステートに書き込む
+                callback_context = CallbackContext(ctx)
+                create_whisky_id(callback_context)
+                callback_context.state["whisky_info"] = cached
+                yield Event(
+                    invocation_id=ctx.invocation_id,
+                    author=self.name,
+                    branch=ctx.branch,
+                    actions=callback_context._event_actions,
+                )
+                return
+
+        async for event in self._extract(ctx):
+            yield event
+
+        # 主要項目が揃った結果のみキャッシュする
+        whisky_info = ctx.session.state.get("whisky_info") or {}
+        if image_hashes is not None and all(whisky_info.get(field) for field in KEY_FIELDS):
+            label_cache.put(*image_hashes, whisky_info)
+
+    async def _extract(self, ctx: InvocationContext) -> AsyncGenerator[Event, None]:
+        if not LABEL_ADAPTIVE_RESOLUTION:
+            async for event in self.full_extracter.run_async(ctx):
+                yield event
+            return
+
+        adaptive_resolution_stats.runs += 1
+        started_at = time.monotonic()
+        async for event in self.thumbnail_extracter.run_async(ctx):
+            yield event
+        adaptive_resolution_stats.thumbnail_seconds += time.monotonic() - started_at
+
+        whisky_info = ctx.session.state.get("whisky_info") or {}
+        missing = [field for field in KEY_FIELDS if not whisky_info.get(field)]
+        if not missing:
+            return
+
+        print(f"--- Label extraction escalated to full resolution (missing: {', '.join(missing)}) ---")
+        adaptive_resolution_stats.escalations += 1
+        started_at = time.monotonic()
+        async for event in self.full_extracter.run_async(ctx):
+            yield event
+        adaptive_resolution_stats.full_seconds += time.monotonic() - started_at
+
+
+def render_label_summary(whisky_info: dict, template: str = LABEL_SUMMARY_TEMPLATE) -> str:
+    """抽出したウイスキー情報を返答用の文章にする"""
+    fields = {
+        field: whisky_info.get(field) or LABEL_SUMMARY_EMPTY_VALUE
+        for field in WhiskyInfo.model_fields
+    }
+    return template.format(**fields)
+
+
+class LabelSummaryRenderer(BaseAgent):
+    """state["whisky_info"]をテンプレートで文章化するエージェント（LLMを呼ばない）"""
+
+    template: str = LABEL_SUMMARY_TEMPLATE
+
+    async def _run_async_impl(self, ctx: InvocationContext) -> AsyncGenerator[Event, None]:
+        whisky_info = ctx.session.state.get("whisky_info") or {}
+        yield Event(
+            invocation_id=ctx.invocation_id,
+            author=self.name,
+            branch=ctx.branch,
+            content=types.Content(
+                role="model",
+                parts=[types.Part(text=render_label_summary(whisky_info, self.template))],
+            ),
+        )
+
 
 output_reviser = Agent(
     name="output_reviser",
@@ -18,6 +213,7 @@ output_reviser = Agent(
     生産国: スコットランド/日本 (例)
     生産地域: アイラ島/未明 (例)
     ウイスキーの種類: シングルモルト/ブレンデッド (例)
+
     この情報を修正・保存しますか？
     """,
 )
@@ -29,12 +225,37 @@ image_extracter = Agent(
     output_key="whisky_info",
     disallow_transfer_to_parent=True,
     disallow_transfer_to_peers=True,
-    before_agent_callback=create_whisky_id
+    before_agent_callback=create_whisky_id,
+    before_model_callback=use_thumbnail_image,
     )
 
+image_extracter_full = Agent(
+    name="image_extracter_full",
+    instruction=IMAGE_EXTRACTER_INSTRUCTION,
+    output_schema=WhiskyInfo,
+    output_key="whisky_info",
+    disallow_transfer_to_parent=True,
+    disallow_transfer_to_peers=True,
+    before_agent_callback=create_whisky_id,
+    before_model_callback=count_full_image_bytes,
+    )
+
+adaptive_label_extracter = AdaptiveLabelExtracter(
+    name="adaptive_label_extracter",
+    thumbnail_extracter=image_extracter,
+    full_extracter=image_extracter_full,
+)
+
+label_summary_renderer = LabelSummaryRenderer(
+    name="label_summary_renderer",
+    description="抽出したウイスキー情報をテンプレートで文章化する",
+)
 
 whisky_label_processor = SequentialAgent(
     name="whisky_label_processor",
     description="ウイスキーのラベル画像から情報を抽出し、ユーザーに文章にして回答する",
-    sub_agents=[image_extracter, output_reviser],
+    sub_agents=[
+        adaptive_label_extracter,
+        output_reviser if LABEL_SUMMARY_MODE == "llm" else label_summary_renderer,
+    ],
 )
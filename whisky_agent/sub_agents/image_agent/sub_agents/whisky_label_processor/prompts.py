@@ -44,3 +44,14 @@ IMAGE_EXTRACTER_INSTRUCTION = """
     - 画像から読み取れない情報は空文字列として返却
     - 情報の正確性を最優先し、不確かな情報は含めない
 """
+
+# output_reviserの代わりにPythonで整形する場合の返答テンプレート
+LABEL_SUMMARY_TEMPLATE = """こちらがウイスキーの情報です。
+銘柄: {brand}
+熟成年数: {age}
+蒸溜所: {distillery}
+生産国: {country}
+生産地域: {region}
+ウイスキーの種類: {whisky_type}
+
+この情報を修正・保存しますか？"""
@@ -3,26 +3,67 @@ from google.adk.tools.agent_tool import AgentTool
 from google.adk.tools.tool_context import ToolContext
 from typing import List
 from pydantic import BaseModel, Field, ValidationError
-from collections import Counter
-from ...storage.firestore import FirestoreClient # FirestoreClientをインポート
+from ...storage.firestore import get_firestore_client_async # 共有のFirestoreClientを取得する関数をインポート
+from ...analytics import compute_history_analytics, compute_trends
+from ...storage import trend_cache
 from .prompts import look_back_agent_INSTRUCTION
+from ...router import update_conversation_phase
 
 
-async def get_my_history(tool_context: ToolContext) -> dict:
-    """ユーザーのウイスキー履歴をFirestoreから取得する
+async def get_my_stats(include_brands: bool, tool_context: ToolContext) -> dict:
+    """ユーザーのウイスキー履歴の統計を取得する（振り返りの集計はすべてこのツールで取得する）
+
+    種類・生産国・地域・熟成年数の区分ごとの件数、評価の分布、評価と熟成年数の平均を返す。
+    これらは保存のたびに更新される集計ドキュメントを1件読むだけなので、履歴の件数によらず高速に取得できる。
+    include_brandsがTrueの場合は履歴から計算した評価の中央値・ばらつきと、
+    評価の高い銘柄とその香り・味わい・余韻の特徴も返す（生の履歴は返さない）。
 
     Args:
+        include_brands: 銘柄やテイスティングノートの振り返りに必要な場合はTrue、件数や分布だけでよい場合はFalse
         tool_context: セッションステートにアクセスするためのコンテキスト
 
     Returns:
-        保存結果の確認メッセージを含む辞書
+        集計結果を含む辞書
     """
     user_id = tool_context.state.get("user_id", 'default_user_id')
 
-    firestore_client = FirestoreClient()
+    firestore_client = await get_firestore_client_async()
+    stats = await firestore_client.get_user_aggregates(user_id)
+    if not include_brands:
+        return stats
+
     history = await firestore_client.get_whisky_history(user_id)
+    analytics = compute_history_analytics(history)
+    rating = analytics.get("rating", {})
+    stats["rating_median"] = rating.get("median")
+    stats["rating_std"] = rating.get("std")
+    stats["top_brands"] = analytics.get("top_brands", [])
+    return stats
+
+
+async def analyze_my_trends(granularity: str, tool_context: ToolContext) -> dict:
+    """ユーザーのウイスキー履歴の時系列の傾向を取得する
 
-    return history
+    記録した日時（初回保存時のcreated_at）で月別または四半期別にまとめ、期間ごとの件数、評価の平均と移動平均、
+    最も多い地域・種類、直近の期間とそれ以前での地域・種類の構成比の変化を返す。記録のない期間も件数0で含む。
+    created_atがない記録（created_atの導入前の記録や、USER_AGGREGATES_ENABLEDが無効な環境での記録）は
+    最終更新日時(updated_at)でまとめるため、編集やテイスティングノートの保存をすると最新の期間に移る。
+    「最近どう変わった？」のような質問に使う。
+
+    Args:
+        granularity: 集計の粒度。"month"（月別）または"quarter"（四半期別）
+        tool_context: セッションステートにアクセスするためのコンテキスト
+
+    Returns:
+        時系列の分析結果を含む辞書
+    """
+    user_id = tool_context.state.get("user_id", 'default_user_id')
+
+    firestore_client = await get_firestore_client_async()
+    history = await firestore_client.get_whisky_history(user_id)
+    # 前回から変化したドキュメントだけを月別集計に反映する
+    monthly_buckets = trend_cache.sync(user_id, history)
+    return compute_trends(monthly_buckets, granularity)
 
 
 look_back_agent = Agent(
@@ -30,5 +71,6 @@ look_back_agent = Agent(
     model="gemini-2.5-flash",
     description="ユーザーからのリクエストに基づき、過去の履歴の提供、傾向の分析を行うエージェント",
     instruction=look_back_agent_INSTRUCTION,
-    tools=[get_my_history]
+    tools=[get_my_stats, analyze_my_trends],
+    before_agent_callback=update_conversation_phase,
     )
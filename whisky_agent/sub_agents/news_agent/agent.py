@@ -1,5 +1,6 @@
 from google.adk.agents import Agent
 from .prompts import NEWS_AGENT_INSTRUCTION
+from ...router import update_conversation_phase
 from google.adk.tools import google_search
 from google.adk.tools.agent_tool import AgentTool
 from google.adk.tools.langchain_tool import LangchainTool
@@ -38,5 +39,6 @@ news_agent = Agent(
     name='news_agent',
     description="ウイスキーのニュース検索に特化したエージェント",
     instruction=NEWS_AGENT_INSTRUCTION,
-    tools=[AgentTool(search_agent)]
+    tools=[AgentTool(search_agent)],
+    before_agent_callback=update_conversation_phase,
     )
@@ -1,39 +1,104 @@
 from google.adk.agents import Agent
 from google.adk.tools.agent_tool import AgentTool
 from google.adk.tools.tool_context import ToolContext
-from ...storage.firestore import FirestoreClient
+from ...analytics import build_preference_profile
+from ...models import TastingAnalysis, WhiskyInfo
+from ...storage.firestore import get_firestore_client_async
 from .prompts import RECOMMEND_AGENT_INSTRUCTION
+from ...router import update_conversation_phase
+
+# 記録をそのまま返す場合に読み込むフィールド（ウイスキー情報・テイスティングノートと保存日時だけ）
+HISTORY_RECORD_FIELDS = [*WhiskyInfo.model_fields, *TastingAnalysis.model_fields, "updated_at"]
 
 async def get_my_history(tool_context: ToolContext) -> dict:
-    """ユーザーのウイスキー履歴をFirestoreから取得する
+    """ユーザーのウイスキー履歴から好みのプロファイルを取得する
+
+    履歴全体をまとめた、よく飲む地域・種類、好きな香り・味わい・余韻の特徴、評価の統計、
+    最近の銘柄と評価の高い銘柄を返す（個々の記録をすべて見る必要がある場合はget_my_history_pageを使う）。
 
     Args:
         tool_context: セッションステートにアクセスするためのコンテキスト
 
     Returns:
-        保存結果の確認メッセージを含む辞書
+        好みのプロファイルを含む辞書
     """
     user_id = tool_context.state.get("user_id", 'default_user_id')
 
-    firestore_client = FirestoreClient()
+    firestore_client = await get_firestore_client_async()
     history = await firestore_client.get_whisky_history(user_id)
 
-    return history
+    return build_preference_profile(history)
+
+async def get_my_history_page(cursor: str, tool_context: ToolContext) -> dict:
+    """ユーザーのウイスキー履歴の記録そのものを新しい順に1ページずつ取得する
+
+    get_my_historyのプロファイルに含まれない個々の記録を確認する必要がある場合だけ使う。
+
+    Args:
+        cursor: 前のページの結果のnext_cursor（最初のページは空文字）
+        tool_context: セッションステートにアクセスするためのコンテキスト
+
+    Returns:
+        記録のリスト(records)と次のページのカーソル(next_cursor、最後のページの場合はNone)を含む辞書
+    """
+    user_id = tool_context.state.get("user_id", 'default_user_id')
+
+    firestore_client = await get_firestore_client_async()
+    records, next_cursor = await firestore_client.get_whisky_history_page(
+        user_id, fields=HISTORY_RECORD_FIELDS, cursor=cursor or None
+    )
+
+    return {"records": records, "next_cursor": next_cursor}
 
-async def get_other_history(tool_context: ToolContext) -> dict:
-    """他のユーザーのウイスキー履歴をFirestoreから取得する
+async def get_other_history(num_users: int, tool_context: ToolContext) -> dict:
+    """他のユーザーの好みのプロファイルを取得する
+
+    他のユーザーをランダムに選び、ユーザーごとの好みのプロファイルを返す（ユーザーIDは含めない）。
 
     Args:
+        num_users: 参考にするユーザー数（1〜3、多いほど幅広い候補が得られる）
         tool_context: セッションステートにアクセスするためのコンテキスト
 
     Returns:
-        保存結果の確認メッセージを含む辞書
+        ランダムに選んだ他のユーザーの好みのプロファイルのリスト(profiles)を含む辞書
     """
     user_id = tool_context.state.get("user_id", 'default_user_id')
-    firestore_client = FirestoreClient()
-    history = await firestore_client.get_whisky_history(exclude_user_id=user_id)  # 現在のユーザーIDを除外
+    firestore_client = await get_firestore_client_async()
+    # 現在のユーザーを除いてサンプリングする
+    others = await firestore_client.get_other_users_history(exclude_user_id=user_id, num_users=num_users)
+
+    return {"profiles": [build_preference_profile(other["history"]) for other in others if other["history"]]}
 
-    return history
+async def get_cooccurrence_recommendations(tool_context: ToolContext) -> list:
+    """ユーザーが記録したウイスキーを一緒に記録している他のユーザーが、他に記録しているウイスキーを取得する
+
+    全ユーザーの記録から作った共起インデックスを使い、「Xを記録した人はYも記録している」候補を
+    関連の強い順に返す（ユーザーが記録済みのものは除く）。
+    インデックスの作成中は空のリストを返すため、その場合はget_other_historyを使う。
+
+    Args:
+        tool_context: セッションステートにアクセスするためのコンテキスト
+
+    Returns:
+        候補のウイスキー名、スコア、一緒に記録しているユーザー数、きっかけとなったユーザーの記録のリスト
+    """
+    user_id = tool_context.state.get("user_id", 'default_user_id')
+    firestore_client = await get_firestore_client_async()
+    return await firestore_client.get_cooccurrence_recommendations(user_id)
+
+async def find_similar_whiskies(query: str, tool_context: ToolContext) -> list:
+    """テイスティングノートの特徴が似ているウイスキーを全ユーザーの記録から探す
+
+    Args:
+        query: 銘柄名（例: "山崎12年"）、または香り・味わいの特徴を読点で区切った文字列（例: "バニラ、蜂蜜、スモーキー"）
+        tool_context: セッションステートにアクセスするためのコンテキスト
+
+    Returns:
+        似ているウイスキー名、類似度、クエリと共通の特徴、そのウイスキーの特徴のリスト
+        （インデックスの作成中は空のリスト）
+    """
+    firestore_client = await get_firestore_client_async()
+    return await firestore_client.find_similar_whiskies(query)
 
 
 recommend_agent = Agent(
@@ -42,6 +107,10 @@ recommend_agent = Agent(
     description="ユーザーの好みやウイスキー履歴を分析し、パーソナライズされたウイスキー推薦や一般的な日常会話やウイスキーの知識を提供するエージェント",
     instruction=RECOMMEND_AGENT_INSTRUCTION,
     tools=[get_my_history,
+           get_my_history_page,
+           get_cooccurrence_recommendations,
+           find_similar_whiskies,
            get_other_history,
-           ]
+           ],
+    before_agent_callback=update_conversation_phase,
     )
@@ -1,14 +1,15 @@
 from google.adk.agents import Agent
 from google.adk.tools.agent_tool import AgentTool
 from google.adk.tools.tool_context import ToolContext
-from ...storage.firestore import FirestoreClient
+from ...storage.firestore import get_firestore_client_async
 from .sub_agents.tasting_note_creator import tasting_note_creator
 from .sub_agents.tasting_note_modifier import tasting_note_modifier
 from ...models import WhiskyInfo
 from ...models import create_whisky_id
 from .prompts import tasting_note_agent_INSTRUCTION
+from ...router import update_conversation_phase
 
-def save_tasting_note(tool_context: ToolContext) -> dict:
+async def save_tasting_note(tool_context: ToolContext) -> dict:
     """テイスティングノートをFirestoreに保存する
 
     Args:
@@ -25,10 +26,9 @@ def save_tasting_note(tool_context: ToolContext) -> dict:
     tasting_note = tool_context.state.get("tasting_note", {})
     whisky_info = tool_context.state.get("whisky_info", {})
 
-    # Firestoreクライアントを使用してテイスティングノートを保存
-    firestore_client = FirestoreClient()
-    firestore_client.save_whisky_info(user_id, whisky_id, tasting_note)
-    firestore_client.save_whisky_info(user_id, whisky_id, whisky_info)
+    # テイスティングノートとウイスキー情報を1回の書き込みでまとめて保存
+    firestore_client = await get_firestore_client_async()
+    await firestore_client.save_whisky_info_async(user_id, whisky_id, {**tasting_note, **whisky_info})
 
     return {
         "action": "save_tasting_note_to_firestore",
@@ -60,4 +60,6 @@ tasting_note_agent = Agent(
         AgentTool(tasting_note_modifier),
         save_tasting_note,
         AgentTool(whisky_info_creator),
-    ])
+    ],
+    before_agent_callback=update_conversation_phase,
+    )
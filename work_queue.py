@@ -0,0 +1,119 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Optional
+
+
+class WorkQueue:
+    """Webhookで受け付けたイベントを処理する有界キューとワーカープール
+
+    Webhookは署名検証後にジョブを積むだけで即座に応答し、
+    実際のエージェント処理はバックグラウンドのワーカーが順次取り出して実行する。
+    """
+
+    def __init__(self, maxsize: int = 100, num_workers: int = 4):
+        self.maxsize = maxsize
+        self.num_workers = num_workers
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: list = []
+        self._started_at: Optional[float] = None
+
+        # メトリクス
+        self._busy_workers = 0
+        self._busy_seconds = 0.0
+        self._wait_seconds_total = 0.0
+        self._wait_seconds_max = 0.0
+        self.enqueued = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+
+    async def start(self):
+        """ワーカープールを起動する（起動済みの場合は何もしない）"""
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._started_at = time.monotonic()
+        self._workers = [
+            asyncio.create_task(self._worker(i)) for i in range(self.num_workers)
+        ]
+        print(f"Work queue started: maxsize={self.maxsize}, workers={self.num_workers}")
+
+    async def stop(self, timeout: float = 10.0):
+        """残っているジョブを待ってからワーカーを停止する"""
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            print(f"Work queue stop timed out with {self._queue.qsize()} pending jobs")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = None
+        print("Work queue stopped")
+
+    def can_accept(self) -> bool:
+        """起動済みでキューに空きがあるか"""
+        return self._queue is not None and not self._queue.full()
+
+    def submit(self, job: Callable[[], Awaitable], label: str = "") -> bool:
+        """ジョブをキューに積む
+
+        Args:
+            job: 引数なしで呼び出すとコルーチンを返す関数
+            label: ログ用のラベル
+        Returns:
+            キューに積めた場合はTrue、満杯または未起動の場合はFalse
+        """
+        if self._queue is None:
+            print(f"Work queue is not running, rejected job: {label}")
+            self.rejected += 1
+            return False
+        try:
+            self._queue.put_nowait((time.monotonic(), job, label))
+        except asyncio.QueueFull:
+            print(f"Work queue is full ({self.maxsize}), rejected job: {label}")
+            self.rejected += 1
+            return False
+        self.enqueued += 1
+        return True
+
+    async def _worker(self, index: int):
+        while True:
+            enqueued_at, job, label = await self._queue.get()
+            started_at = time.monotonic()
+            wait_seconds = started_at - enqueued_at
+            self._wait_seconds_total += wait_seconds
+            self._wait_seconds_max = max(self._wait_seconds_max, wait_seconds)
+            self._busy_workers += 1
+            try:
+                await job()
+                self.completed += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"Worker {index} failed to process job {label}: {e}")
+            finally:
+                self._busy_workers -= 1
+                self._busy_seconds += time.monotonic() - started_at
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        """キューの深さ・待ち時間・ワーカー稼働率を返す"""
+        uptime = time.monotonic() - self._started_at if self._started_at else 0.0
+        started = self.completed + self.failed + self._busy_workers
+        capacity_seconds = uptime * self.num_workers
+        return {
+            "running": self._queue is not None,
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "queue_maxsize": self.maxsize,
+            "workers": self.num_workers,
+            "busy_workers": self._busy_workers,
+            "utilization": round(self._busy_seconds / capacity_seconds, 4) if capacity_seconds else 0.0,
+            "avg_wait_ms": round(self._wait_seconds_total / started * 1000, 1) if started else 0.0,
+            "max_wait_ms": round(self._wait_seconds_max * 1000, 1),
+            "enqueued": self.enqueued,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "failed": self.failed,
+        }